@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import time
+import shutil
+import resource
+import tempfile
+import contextlib
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+
+import click
+
+# Ensure we can import from local modules
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import manage
+
+
+PARAGRAPH = ("Students work through each unit at their own pace, with "
+             "*feedback* from a certified teacher on every **assignment**. "
+             "See the [course guide](/courses/guide) for details.\n\n")
+
+FAQ = ("## Frequently asked questions\n\n"
+       "- Is the course accredited? Yes.\n"
+       "- Can I start any time? Yes.\n\n")
+
+
+def write_file(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(content)
+
+
+def generate_site(root, pages, depth, markdown, bundles):
+    """
+    Writes a synthetic site to root and returns its config, in the same
+    schema as data.yaml.
+    """
+    write_file(os.path.join(root, 'src/layouts/layout.html'), (
+        "<!DOCTYPE html>\n<html><head><title>{{ title }}</title>\n"
+        "{% for bundle in css_bundles %}"
+        "<link rel=\"stylesheet\" href=\"{{ asset_url(bundle) }}\">\n"
+        "{% endfor %}"
+        "<script src=\"{{ asset_url('js/scripts.js') }}\" defer></script>\n"
+        "</head><body>{% include 'header.html' %}\n"
+        "<nav>{% for item in nav_pages %}<a href=\"/{{ item.dest }}\">"
+        "{{ item.title }}</a>{% endfor %}</nav>\n"
+        "{% block content %}{% endblock %}</body></html>\n"))
+    write_file(os.path.join(root, 'src/partials/header.html'),
+               "<header><h1>{{ title }}</h1></header>\n")
+    # Each partial renders the next one, down to depth levels
+    for level in range(depth):
+        child = (f"{{{{ render_partial('partial-{level + 1}', {{'level': {level + 1}}}, _context) }}}}"
+                 if level + 1 < depth else '')
+        write_file(os.path.join(root, f'src/partials/partial-{level}.html'),
+                   f"<section class=\"level-{{{{ level }}}}\">"
+                   f"{{% for i in range(3) %}}<p>{{{{ title }}}} {{{{ i }}}}</p>{{% endfor %}}"
+                   f"{child}</section>\n")
+
+    for page in range(pages):
+        body = f"# Page {page}\n\n" + PARAGRAPH * markdown
+        write_file(os.path.join(root, f'src/pages/page-{page}.html'), (
+            f"---\ntitle: Page {page}\nnav_item: {str(page < 10).lower()}\n"
+            f"order: {page}\n---\n"
+            "{% extends 'layout.html' %}{% block content %}\n"
+            f"{{% filter markdown %}}{body}{{% endfilter %}}\n"
+            f"{{{{ {json.dumps(FAQ)} | markdown }}}}\n"
+            + ("{{ render_partial('partial-0', {'level': 0}, _context) }}\n" if depth else '')
+            + "{% endblock %}\n"))
+
+    scss_paths = {}
+    write_file(os.path.join(root, 'src/scss/variables.scss'),
+               "$primary: #336699;\n$spacing: 1rem;\n")
+    write_file(os.path.join(root, 'src/scss/common.scss'),
+               "".join(f".block-{i} {{ margin: $spacing * {i % 4}; "
+                       f"color: darken($primary, {i % 20}%); "
+                       f"&:hover {{ color: $primary; }} }}\n"
+                       for i in range(200)))
+    for bundle in range(bundles):
+        write_file(os.path.join(root, f'src/scss/bundle-{bundle}.scss'),
+                   f".bundle-{bundle} {{ padding: $spacing; .inner {{ color: $primary; }} }}\n")
+        scss_paths[f'css/bundle-{bundle}.css'] = ['variables.scss', 'common.scss',
+                                                  f'bundle-{bundle}.scss']
+
+    for name in ('header', 'forms'):
+        write_file(os.path.join(root, f'src/js/{name}.js'),
+                   "(function () {\n  // Setup\n" + "".join(
+                       f"  var item{i} = document.querySelector('#item-{i}');\n"
+                       for i in range(100)) + "})();\n")
+
+    return {
+        'options': {
+            'dist': 'dist',
+            'images': 'images',
+            'cache_dir': '.build-cache',
+            'fingerprint_assets': True,
+        },
+        'js': {
+            'paths': {'js/scripts.js': ['header.js', 'forms.js']},
+            'search': ['src/js/'],
+        },
+        'scss': {
+            'paths': scss_paths,
+            'search': ['src/scss/'],
+        },
+        'html': [{
+            'files': [{'src': ['src/pages/*.html'],
+                       'template': 'layout.html',
+                       'dest': ''}],
+            'partials': ['src/partials/*.html'],
+            'layouts': ['src/layouts/layout.html'],
+            'options': {'nav': True},
+        }],
+    }
+
+
+def run_build(root, data):
+    """Builds the site in root in this process, returning timings and peak memory."""
+    # Keep the benchmark offline
+    manage.perform_image_sync = lambda data: None
+    os.chdir(root)
+    t1 = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        profiler = manage.build_site(data)
+    total = time.perf_counter() - t1
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return {
+        'total': total,
+        'phases': {phase['name']: {'wall': phase['wall'], 'cpu': phase['cpu']}
+                   for phase in profiler.phases},
+        # ru_maxrss is in kilobytes on Linux
+        'peak_rss_kb': max(self_usage.ru_maxrss, children_usage.ru_maxrss),
+    }
+
+
+def run_in_subprocess(root, data):
+    # A fresh process per build, so caches in memory and peak RSS start clean
+    with ProcessPoolExecutor(max_workers=1) as executor:
+        return executor.submit(run_build, root, data).result()
+
+
+def get_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                              capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+@click.group()
+def cli():
+    """Benchmarks the build against synthetic sites."""
+    pass
+
+@cli.command()
+@click.option('--pages', default=200, help='Number of pages.')
+@click.option('--depth', default=3, help='Depth of nested render_partial calls per page.')
+@click.option('--markdown', default=20, help='Markdown paragraphs per page.')
+@click.option('--bundles', default=2, help='Number of SCSS bundles.')
+@click.option('--jobs', default=1, type=click.IntRange(min=1), help='Number of processes rendering pages.')
+@click.option('--repeat', default=3, type=click.IntRange(min=1), help='Number of timed runs of each kind.')
+@click.option('--results', default='bench_results.jsonl', help='File the results are appended to.')
+def run(pages, depth, markdown, bundles, jobs, repeat, results):
+    """Times cold (empty cache), warm and incremental builds of a synthetic site."""
+    params = {'pages': pages, 'depth': depth, 'markdown': markdown,
+              'bundles': bundles, 'jobs': jobs}
+    root = tempfile.mkdtemp(prefix='bench-site-')
+    try:
+        data = generate_site(root, pages, depth, markdown, bundles)
+        data['options']['jobs'] = jobs
+        runs = {'cold': [], 'warm': [], 'incremental': []}
+        for i in range(repeat):
+            click.echo(f'Run {i + 1}/{repeat}...')
+            shutil.rmtree(os.path.join(root, '.build-cache'), ignore_errors=True)
+            runs['cold'].append(run_in_subprocess(root, data))
+            runs['warm'].append(run_in_subprocess(root, data))
+            runs['incremental'].append(run_in_subprocess(
+                root, dict(data, options=dict(data['options'], incremental=True))))
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+    result = {
+        'commit': get_commit(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': sys.version.split()[0],
+        'params': params,
+        # The fastest of the repeats is the least noisy
+        'runs': {kind: min(timings, key=lambda run: run['total'])
+                 for kind, timings in runs.items()},
+    }
+    with open(results, 'a') as f:
+        f.write(json.dumps(result) + '\n')
+
+    for kind, timing in result['runs'].items():
+        click.echo(f"{kind:<12} {timing['total']:>8.4f} s  "
+                   f"html {timing['phases']['html']['wall']:.4f} s  "
+                   f"peak {timing['peak_rss_kb'] // 1024} MB")
+    click.echo(f'Appended results to {results}')
+
+@cli.command()
+@click.option('--results', default='bench_results.jsonl', help='File the results were appended to.')
+def compare(results):
+    """Compares the last two results recorded with the same parameters."""
+    with open(results) as f:
+        entries = [json.loads(line) for line in f if line.strip()]
+    if not entries:
+        click.echo('No results recorded.')
+        return
+    latest = entries[-1]
+    previous = [entry for entry in entries[:-1] if entry['params'] == latest['params']]
+    if not previous:
+        click.echo(f"No earlier results with parameters {latest['params']}.")
+        return
+    before = previous[-1]
+
+    click.echo(f"{before['commit']} -> {latest['commit']}  {latest['params']}")
+    for kind in latest['runs']:
+        old, new = before['runs'][kind], latest['runs'][kind]
+        click.echo(f'\n{kind}')
+        rows = [('total', old['total'], new['total'])]
+        rows += [(name, old['phases'].get(name, {}).get('wall', 0), phase['wall'])
+                 for name, phase in new['phases'].items()]
+        for name, old_seconds, new_seconds in rows:
+            change = f'{(new_seconds - old_seconds) / old_seconds:+.1%}' if old_seconds else ''
+            click.echo(f'  {name:<12} {old_seconds:>8.4f} -> {new_seconds:>8.4f} s {change}')
+        click.echo(f"  {'peak MB':<12} {old['peak_rss_kb'] // 1024:>8} -> {new['peak_rss_kb'] // 1024:>8}")
+
+if __name__ == '__main__':
+    cli()
@@ -10,6 +10,15 @@ import boto3
 import yaml
 import shutil
 import requests
+import hashlib
+import json
+import mimetypes
+from urllib.parse import quote
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from botocore.exceptions import BotoCoreError, ClientError
+import threading
+from watchdog.observers import Observer
+from watchdog.events import FileSystemEventHandler
 
 # Ensure we can import from local modules
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
@@ -62,8 +71,45 @@ def parse_template_parameters(template_file='template.yaml'):
         click.echo(f"Warning: Failed to parse {template_file}: {e}")
         return []
 
+# Stack outputs already fetched in this run, keyed by profile, region and stack
+_stack_outputs = {}
+
+# Seconds local builds reuse stack outputs saved on disk. Deploys never do.
+LOCAL_STACK_OUTPUTS_TTL = 3600
+
+def get_stack_outputs_cache_path(options):
+    return os.path.join(tools.get_cache_dir(options), 'stack-outputs.json')
+
+def load_stack_outputs_cache(options):
+    path = get_stack_outputs_cache_path(options)
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except ValueError:
+        # A corrupt cache is a miss
+        return {}
+
 def get_stack_outputs(stack_name, region, options):
-    """Retrieves outputs from a CloudFormation stack."""
+    """
+    Retrieves outputs from a CloudFormation stack.
+    Each stack is only described once per run. With options['stack_outputs_ttl']
+    set, outputs are also saved in the build cache and reused by later runs
+    until they are that many seconds old. forget_stack_outputs drops them once
+    a deploy may have changed the stack.
+    """
+    key = f"{options.get('aws_profile_name', '')}:{region}:{stack_name}"
+    if key in _stack_outputs:
+        return dict(_stack_outputs[key])
+
+    ttl = options.get('stack_outputs_ttl')
+    if ttl:
+        cached = load_stack_outputs_cache(options).get(key)
+        if cached and time.time() - cached['time'] < ttl:
+            _stack_outputs[key] = cached['outputs']
+            return dict(cached['outputs'])
+
     # Use get_client to ensure we use the correct profile if specified
     client = get_client('cloudformation', options)
     try:
@@ -76,7 +122,26 @@ def get_stack_outputs(stack_name, region, options):
     if 'Stacks' in response and len(response['Stacks']) > 0:
         for output in response['Stacks'][0].get('Outputs', []):
             outputs[output['OutputKey']] = output['OutputValue']
-    return outputs
+    _stack_outputs[key] = outputs
+
+    if ttl:
+        cache = load_stack_outputs_cache(options)
+        cache[key] = {'time': time.time(), 'outputs': outputs}
+        with tools.atomic_write(get_stack_outputs_cache_path(options)) as f:
+            json.dump(cache, f, indent=1)
+    return dict(outputs)
+
+def forget_stack_outputs(stack_name, options):
+    """Drops the cached outputs of stack_name, in memory and on disk."""
+    suffix = f':{stack_name}'
+    for key in [key for key in _stack_outputs if key.endswith(suffix)]:
+        del _stack_outputs[key]
+
+    cache = load_stack_outputs_cache(options)
+    if any(key.endswith(suffix) for key in cache):
+        cache = {key: value for key, value in cache.items() if not key.endswith(suffix)}
+        with tools.atomic_write(get_stack_outputs_cache_path(options)) as f:
+            json.dump(cache, f, indent=1)
 
 def ensure_secrets(secrets_list, options, env):
     """
@@ -145,90 +210,206 @@ def check_stack_status(stack_name, options):
                     click.echo("Deletion initiated. Waiting for stack to be deleted...")
                     waiter = client.get_waiter('stack_delete_complete')
                     waiter.wait(StackName=stack_name)
+                    forget_stack_outputs(stack_name, options)
                     click.echo("Stack deleted.")
     except client.exceptions.ClientError:
         # Stack doesn't exist, which is fine
         click.echo("Stack does not exist (clean state).")
         pass
 
-def build_site(data):
-    """Builds the static website using website.tools."""
-    print('\nStarting build!')
-    t0 = time.time()
-
-    print('\n\n=== E M A I L S ===')
-    tools.build_emails(data)
-
-    print('\n\n=== C L E A N ===')
-    if 'dist' in data['options']:
-        print(f'cleaning {data["options"]["dist"]}...', end='')
-        tools.clean(data['options']['dist'])
-        print(' Done!')
-
+def build_phases(data, profiler, dist):
+    """
+    Runs the build steps into data['options']['dist'], which build_site
+    points at the staging directory for dist. Returns the BuildManifest of
+    the pages built, for build_site to save once the output is in place.
+    """
+    manifest = None
     print('\n\n=== I M A G E S ===')
-    if 'images' in data['options']:
-        # Automatically sync images to S3 during build
-        perform_image_sync(data)
+    with profiler.phase('images'):
+        if 'responsive_images' in data and 'images' in data['options']:
+            tools.handle_responsive_images(data)
+        if 'images' in data['options']:
+            # Automatically sync images to S3 during build
+            perform_image_sync(data)
 
     print('\n\n=== J S ===')
-    if 'js' in data:
-        for dest_path in data['js']['paths']:
-            tools.handle_js(data, dest_path)
+    with profiler.phase('js'):
+        if 'js' in data:
+            # Layouts load the common chunk, if any, before the other bundles
+            bundle_files = tools.get_bundle_files(data, 'js')
+            common = data['js'].get('common')
+            data['options']['js_common'] = common if common in bundle_files else None
+            data['options']['empty_bundles'] = tools.get_empty_bundles(data, 'js')
+            tools.report_duplicate_sources(data, 'js')
+            for dest_path in bundle_files:
+                tools.handle_js(data, dest_path)
 
     print('\n\n=== C S S ===')
-    if 'scss' in data:
-        for dest_path in data['scss']['paths']:
-            tools.handle_scss(data, dest_path)
+    with profiler.phase('css'):
+        if 'scss' in data:
+            tools.report_duplicate_sources(data, 'scss')
+            tools.handle_scss_bundles(data, list(data['scss']['paths']))
 
     print('\n\n=== H T M L ===')
     t1 = time.time()
-    if 'html' in data:
-        for pageset in data['html']:
-            tools.build_pageset(pageset, data['options'])
+    with profiler.phase('html'):
+        if 'html' in data:
+            manifest = tools.BuildManifest(data['options'])
+            for pageset in data['html']:
+                tools.build_pageset(pageset, data['options'], manifest, profiler=profiler)
+            if data['options'].get('incremental'):
+                manifest.remove_stale()
     print(f'Built all pages in {round(float(time.time() - t1), 4)} seconds')
 
     print('\n\n=== T E S T   P A G E S ===')
-    if 'test_forms' in data:
-        tools.generate_test_pages(data, data['options'])
+    with profiler.phase('test_pages'):
+        if 'test_forms' in data:
+            tools.generate_test_pages(data, data['options'])
 
     print('\n\n=== A U D I O ===')
-    if 'audio' in data['options']:
-        tools.handle_audio(data['options'])
+    with profiler.phase('audio'):
+        if 'audio' in data['options']:
+            tools.handle_audio(data['options'])
 
     print('\n\n=== C O P Y ===')
-    if 'copy' in data:
-        tools.copy_files(data['copy'])
+    with profiler.phase('copy'):
+        if 'copy' in data:
+            tools.copy_files({tools.staged_path(dest, dist, data['options']['dist']): files
+                              for dest, files in data['copy'].items()},
+                             data['options'].get('copy_workers', 8))
 
     print('\n\n=== M I S C ===')
     # Symlink .htaccess for non-production (Local) if needed,
     # though AWS S3 doesn't use .htaccess.
     # The original build.py did this for local apache testing.
-    if not data['options'].get('production', False):
-        if 'htaccess' in data['options']:
-            print('Creating symlink for .htaccess...', end='')
-            try:
-                subprocess.run(['ln', '-s',
-                                os.path.join(os.getcwd(), data['options']['htaccess']),
-                                data['options']['dist']], check=False)
-                print(' Done!')
-            except Exception as e:
-                print(f' Failed: {e}')
+    with profiler.phase('misc'):
+        if not data['options'].get('production', False):
+            if 'htaccess' in data['options']:
+                print('Creating symlink for .htaccess...', end='')
+                try:
+                    tools.place_symlink(os.path.join(os.getcwd(), data['options']['htaccess']),
+                                        os.path.join(data['options']['dist'], '.htaccess'))
+                    print(' Done!')
+                except OSError as e:
+                    print(f' Failed: {e}')
+
+    if data['options'].get('compress'):
+        print('\n\n=== C O M P R E S S ===')
+        with profiler.phase('compress'):
+            tools.compress_dist(data['options'])
+
+    return manifest
+
+
+def build_site(data):
+    """
+    Builds the static website using website.tools.
+    The site is built in a staging directory next to dist, which replaces
+    dist only once the whole build has succeeded. Incremental builds seed the
+    staging directory with hard links to the current output.
+    With options['profile'], a timing report is printed and written out.
+    Returns the BuildProfiler holding the timings.
+    """
+    print('\nStarting build!')
+    t0 = time.time()
+    profiler = tools.BuildProfiler()
+
+    print('\n\n=== E M A I L S ===')
+    with profiler.phase('emails'):
+        tools.build_emails(data)
+
+    print('\n\n=== S T A G E ===')
+    dist = data['options']['dist']
+    with profiler.phase('stage'):
+        incremental = data['options'].get('incremental')
+        print(f'Staging {"a copy of " if incremental else ""}{dist}...', end='')
+        staging = tools.stage_dist(dist, seed=incremental)
+        print(' Done!')
+
+    data['options']['dist'] = staging
+    try:
+        manifest = build_phases(data, profiler, dist)
+    except BaseException:
+        print(f'\nBuild failed, leaving {dist} as it was.')
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+    finally:
+        data['options']['dist'] = dist
+
+    with profiler.phase('swap'):
+        tools.swap_dist(dist, staging)
+        # Only now does dist hold what the manifest says was built
+        if manifest is not None:
+            manifest.save()
+    tools.prune_bytecode_cache(data['options'])
 
     print('\n\n=== Entire build done in',
           f'{round(float(time.time() - t0), 4)} seconds ===')
 
+    if data['options'].get('profile'):
+        print('\n\n=== P R O F I L E ===')
+        profiler.print_summary(data['options'].get('profile_top', 10))
+        profiler.write(data['options'])
+
+    return profiler
+
 def upload_file(filename, destname, extra_args, options, client):
-    print(f'Copying {filename} to {options["s3_bucket"]}/{destname}...', end='')
-    with open(filename, 'rb') as f:
-        client.upload_fileobj(f,
-                              options['s3_bucket'],
-                              destname,
-                              ExtraArgs=extra_args)
-    print(' Done!')
+    """
+    Uploads one file, retrying with exponential backoff on errors.
+    Returns the number of bytes sent.
+    """
+    attempts = options.get('upload_attempts', 4)
+    for attempt in range(attempts):
+        try:
+            with open(filename, 'rb') as f:
+                client.upload_fileobj(f,
+                                      options['s3_bucket'],
+                                      destname,
+                                      ExtraArgs=extra_args)
+            return os.path.getsize(filename)
+        except (BotoCoreError, ClientError) as e:
+            if attempt == attempts - 1:
+                raise
+            delay = 0.5 * 2 ** attempt
+            print(f'  Retrying {destname} in {delay} seconds ({e})')
+            time.sleep(delay)
+
+def get_cache_control(filename, destname, options):
+    """
+    Fingerprinted assets never change, so they are cached for a year.
+    HTML uses html_cache_control_age so new asset URLs are picked up quickly.
+    """
+    if destname in options.get('asset_map', {}).values():
+        return 'public, max-age=31536000, immutable'
+    cache_control_age = options.get("cache_control_age", 3600)
+    if filename.endswith('.html'):
+        cache_control_age = options.get('html_cache_control_age', cache_control_age)
+    return f'max-age={cache_control_age}'
 
-def handle_upload_item(filename, destname, options, client):
+def get_upload_body(filename, options):
+    """
+    Returns the file to send for filename and its Content-Encoding. With
+    options['compress'], the pre-compressed variant is sent in place of the
+    original, using options['upload_encoding'] (gzip unless set to br).
+    """
+    if options.get('compress') and filename.endswith(tools.COMPRESSIBLE_EXTENSIONS):
+        encoding = options.get('upload_encoding', 'gzip')
+        body = f"{filename}.{'br' if encoding == 'br' else 'gz'}"
+        if tools.is_encoding_fresh(filename, body):
+            return body, encoding
+    return filename, None
+
+# Object metadata key holding a digest of the headers an object was uploaded with
+HEADERS_DIGEST_KEY = 'headers-digest'
+
+def get_upload_args(filename, destname, options):
+    """
+    Returns the file to send for filename and the ExtraArgs to send it with.
+    The headers are digested into the object's metadata so that a change to
+    them alone is noticed on the next upload.
+    """
     # Determine ContentType and CacheControl
-    extra_args = {'CacheControl': f'max-age={options.get("cache_control_age", 3600)}'}
+    extra_args = {'CacheControl': get_cache_control(filename, destname, options)}
 
     if filename.endswith('.html'):
         extra_args['ContentType'] = 'text/html'
@@ -244,24 +425,98 @@ def handle_upload_item(filename, destname, options, client):
         extra_args['ContentType'] = 'image/png'
     elif filename.endswith('.gif'):
         extra_args['ContentType'] = 'image/gif'
+    elif mimetypes.guess_type(filename)[0]:
+        extra_args['ContentType'] = mimetypes.guess_type(filename)[0]
 
-    upload_file(filename, destname, extra_args, options, client)
+    body, encoding = get_upload_body(filename, options)
+    if encoding:
+        extra_args['ContentEncoding'] = encoding
 
-def upload_to_s3(data):
-    """Uploads the dist directory to S3."""
-    options = data['options']
-    dist_dir = options['dist']
-    bucket = options['s3_bucket']
+    digest = hashlib.sha1(json.dumps(extra_args, sort_keys=True).encode()).hexdigest()
+    extra_args['Metadata'] = {HEADERS_DIGEST_KEY: digest}
+    return body, extra_args
 
-    print(f'\n#####\nUploading {dist_dir} to {bucket}...')
-    s3_client = get_client('s3', options) # uses shared.client
+def handle_upload_item(filename, destname, options, client):
+    body, extra_args = get_upload_args(filename, destname, options)
+    return upload_file(body, destname, extra_args, options, client)
 
-    # Walk through dist directory
-    for filename in glob.glob(f'{dist_dir}/**', recursive=True):
+def upload_items(items, options, client):
+    """
+    Uploads {destname: filename} concurrently on options['upload_workers']
+    threads sharing one client, then prints a throughput summary.
+    Returns the destnames that still failed after their retries.
+    """
+    t1 = time.time()
+    total_bytes = 0
+    failures = []
+    with ThreadPoolExecutor(max_workers=options.get('upload_workers', 16)) as executor:
+        futures = {executor.submit(handle_upload_item, filename, destname, options, client): destname
+                   for destname, filename in items.items()}
+        for count, future in enumerate(as_completed(futures), 1):
+            destname = futures[future]
+            try:
+                total_bytes += future.result()
+                print(f'[{count}/{len(futures)}] {options["s3_bucket"]}/{destname}')
+            except (BotoCoreError, ClientError, OSError) as e:
+                print(f'[{count}/{len(futures)}] FAILED {destname}: {e}')
+                failures.append(destname)
+
+    elapsed = time.time() - t1
+    megabytes = total_bytes / (1024 * 1024)
+    print(f'Uploaded {len(items) - len(failures)} files ({round(megabytes, 2)} MB) '
+          f'in {round(elapsed, 2)} seconds ({round(megabytes / elapsed, 2) if elapsed else 0} MB/s)')
+    return failures
+
+# boto3's default multipart threshold and part size for upload_fileobj
+MULTIPART_CHUNKSIZE = 8 * 1024 * 1024
+
+def get_local_etag(filename):
+    """Computes the ETag S3 will report for filename once uploaded with upload_fileobj."""
+    part_md5s = []
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(MULTIPART_CHUNKSIZE), b''):
+            part_md5s.append(hashlib.md5(chunk))
+
+    if os.path.getsize(filename) < MULTIPART_CHUNKSIZE:
+        return part_md5s[0].hexdigest() if part_md5s else hashlib.md5().hexdigest()
+    combined = hashlib.md5(b''.join(part.digest() for part in part_md5s))
+    return f'{combined.hexdigest()}-{len(part_md5s)}'
+
+def list_remote_etags(client, bucket):
+    """Returns {key: etag} for every object in bucket, handling pagination."""
+    etags = {}
+    paginator = client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket):
+        for item in page.get('Contents', []):
+            etags[item['Key']] = item['ETag'].strip('"')
+    return etags
+
+def get_remote_header_digests(client, bucket, keys, workers):
+    """
+    Returns {key: headers digest} for keys, read from each object's metadata.
+    Objects uploaded before the digest was recorded, or gone, map to None.
+    """
+    def head(key):
+        try:
+            metadata = client.head_object(Bucket=bucket, Key=key)['Metadata']
+        except ClientError:
+            return key, None
+        return key, metadata.get(HEADERS_DIGEST_KEY)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return dict(executor.map(head, keys))
+
+def get_upload_items(dist_dir):
+    """Returns {destname: filename} for every file in dist that should be uploaded."""
+    items = {}
+    for filename in sorted(glob.glob(f'{dist_dir}/**', recursive=True)):
         if os.path.isdir(filename):
             continue
         if os.path.basename(filename).startswith('.'):
             continue
+        # Pre-compressed variants are sent in place of their original
+        if filename.endswith(('.gz', '.br')) and os.path.exists(filename[:-3]):
+            continue
 
         # Calculate destination key
         destname = filename[len(dist_dir)+1:]
@@ -270,28 +525,111 @@ def upload_to_s3(data):
         if destname.endswith('.html'):
             destname = destname[:-5]
 
-        # Determine if we should handle this file (mimicking send_it.py logic logic roughly, but cleaner)
-        # send_it.py had specific checks for html, js/, css/, images/.
-        # We'll just upload everything in dist unless it's hidden.
-        handle_upload_item(filename, destname, options, s3_client)
+        items[destname] = filename
+    return items
+
+def upload_to_s3(data):
+    """
+    Uploads the dist directory to S3, skipping objects whose ETag already
+    matches the local file and whose headers (Cache-Control, Content-Type,
+    Content-Encoding) are unchanged. With options['full_upload'] every file is sent;
+    with options['delete_removed'] objects no longer in dist are deleted.
+    Returns the keys that were uploaded or deleted.
+    """
+    options = data['options']
+    dist_dir = options['dist']
+    bucket = options['s3_bucket']
+
+    print(f'\n#####\nUploading {dist_dir} to {bucket}...')
+    # One client shared by every upload thread, with a connection per thread
+    workers = options.get('upload_workers', 16)
+    s3_client = get_client('s3', options, max_pool_connections=workers, retry_mode='adaptive')
+
+    items = get_upload_items(dist_dir)
+    remote_etags = {} if options.get('full_upload') else list_remote_etags(s3_client, bucket)
+
+    upload_args = {destname: get_upload_args(filename, destname, options)
+                   for destname, filename in items.items()}
+    same_body = [destname for destname, (body, _) in upload_args.items()
+                 if remote_etags.get(destname) == get_local_etag(body)]
+    # Bodies match, but a new Cache-Control or Content-Type still needs sending
+    remote_digests = get_remote_header_digests(s3_client, bucket, same_body, workers)
+    changed_items = {destname: filename for destname, filename in items.items()
+                     if destname not in remote_digests
+                     or remote_digests[destname] != upload_args[destname][1]['Metadata'][HEADERS_DIGEST_KEY]}
+    print(f'{len(changed_items)} changed files, {len(items) - len(changed_items)} unchanged.')
+    failures = upload_items(changed_items, options, s3_client)
+    if failures:
+        click.echo(f"Error: {len(failures)} files failed to upload.")
+        sys.exit(1)
+    changed = list(changed_items)
+
+    if options.get('delete_removed'):
+        if options.get('full_upload'):
+            remote_etags = list_remote_etags(s3_client, bucket)
+        removed = sorted(set(remote_etags) - set(items))
+        # delete_objects takes at most 1000 keys per request
+        for i in range(0, len(removed), 1000):
+            batch = removed[i:i + 1000]
+            s3_client.delete_objects(Bucket=bucket,
+                                     Delete={'Objects': [{'Key': key} for key in batch],
+                                             'Quiet': True})
+        print(f'Deleted {len(removed)} removed files.')
+        changed.extend(removed)
 
     print('Done!\n')
+    return changed
 
-def invalidate_cloudfront(data, distribution_id):
-    """Invalidates the CloudFront cache."""
-    print(f"\nCreating invalidation for distribution {distribution_id}...", end="")
+def get_invalidation_paths(keys, max_paths):
+    """
+    Turns changed S3 keys into CloudFront paths. Index pages also invalidate
+    their directory URL. Above max_paths, the directory with the most paths is
+    collapsed to a wildcard until the list fits, ending at /* if need be.
+    """
+    paths = set()
+    for key in keys:
+        paths.add('/' + quote(key))
+        if key == 'index' or key.endswith('/index'):
+            paths.add('/' + quote(key[:-len('index')]))
+
+    while len(paths) > max_paths:
+        by_parent = {}
+        for path in paths:
+            parent = path.rstrip('*').rstrip('/').rsplit('/', 1)[0]
+            if parent:
+                by_parent.setdefault(parent, set()).add(path)
+        collapsible = [item for item in by_parent.items() if len(item[1]) > 1]
+        if not collapsible:
+            return ['/*']
+        parent, _ = max(collapsible, key=lambda item: (len(item[1]), item[0]))
+        paths = {path for path in paths if not path.startswith(f'{parent}/')}
+        paths.add(f'{parent}/*')
+    return sorted(paths)
+
+def invalidate_cloudfront(data, distribution_id, paths=None):
+    """
+    Invalidates paths (everything by default) in the CloudFront cache.
+    Waits for completion unless options['wait_for_invalidation'] is False.
+    """
+    paths = paths or ["/*"]
+    print(f"\nCreating invalidation of {len(paths)} paths for distribution {distribution_id}...", end="")
     cf_client = get_client("cloudfront", data['options'])
     response = cf_client.create_invalidation(
         DistributionId=distribution_id,
         InvalidationBatch={
             'Paths': {
-                'Quantity': 1,
-                'Items': ["/*"]
+                'Quantity': len(paths),
+                'Items': paths
             },
             'CallerReference': str(time.time())
         }
     )
     print(" Done!")
+    for path in paths:
+        print(f"  {path}")
+    if not data['options'].get('wait_for_invalidation', True):
+        print(f"Not waiting for invalidation {response['Invalidation']['Id']} to complete.")
+        return
     print("Waiting for invalidation to complete... ", end="")
     waiter = cf_client.get_waiter('invalidation_completed')
     waiter.wait(DistributionId=distribution_id, Id=response['Invalidation']['Id'])
@@ -299,40 +637,112 @@ def invalidate_cloudfront(data, distribution_id):
 
 # --- Core Deployment Logic Helpers ---
 
+def get_local_image_etags(image_dirs, previous):
+    """
+    Returns {key: {'filename', 'size', 'mtime', 'etag'}} for every file under
+    each of image_dirs, keyed by its path inside that directory. ETags in
+    previous are reused for files whose size and mtime are unchanged.
+    """
+    images = {}
+    for images_dir in image_dirs:
+        for root, dirs, files in os.walk(images_dir):
+            dirs[:] = [d for d in dirs if not d.startswith('.')]
+            for name in files:
+                if name.startswith('.'):
+                    continue
+                filename = os.path.join(root, name)
+                key = os.path.relpath(filename, images_dir).replace(os.sep, '/')
+                stat = os.stat(filename)
+                entry = previous.get(key)
+                if not (entry and entry.get('filename') == filename
+                        and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime_ns):
+                    entry = {'filename': filename, 'size': stat.st_size,
+                             'mtime': stat.st_mtime_ns, 'etag': get_local_etag(filename)}
+                images[key] = entry
+    return images
+
 def perform_image_sync(data):
-    """Syncs local images to the shared assets bucket."""
+    """
+    Syncs local images to the shared assets bucket.
+    A manifest of the images' ETags and of what the bucket holds is kept in
+    the build cache. The bucket is only looked up and listed again once the
+    manifest is older than options['image_manifest_ttl'] seconds; otherwise
+    only images that changed since the last sync are uploaded, and nothing
+    at all is sent when none did. Skipped with options['offline'].
+    """
+    options = data['options']
+    if options.get('offline'):
+        print("Offline build, skipping image sync.")
+        return
+
     # Get shared stack name
     shared_stack = data.get('parameters', {}).get('shared_stack_name') or data.get('shared_stack_name')
     if not shared_stack:
         print("Warning: shared_stack_name not found in config. Skipping image sync.")
         return
 
-    # Get Bucket Name
-    region = data['options'].get('aws_region_name', 'us-east-1')
-
-    try:
-        outputs = get_stack_outputs(shared_stack, region, data['options'])
-        bucket_name = outputs.get('AssetsBucketName')
-
-        if not bucket_name:
-            print("Warning: Could not fetch AssetsBucketName from stack outputs. Defaulting to 'asyncacademy-assets'.")
-            bucket_name = 'asyncacademy-assets'
-
-        print(f"Syncing images to {bucket_name}...")
+    images_dir = options['images']
+    if not os.path.isdir(images_dir):
+        print(f"Warning: {images_dir} does not exist. Skipping image sync.")
+        return
 
-        cmd = ['aws', 's3', 'sync', 'images/', f's3://{bucket_name}']
+    manifest_path = os.path.join(tools.get_cache_dir(options), 'images-manifest.json')
+    manifest = {}
+    if os.path.exists(manifest_path):
+        try:
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            # An unreadable manifest is a miss, so the bucket is listed again
+            manifest = {}
+        if not isinstance(manifest, dict) or manifest.get('version') != 1 or manifest.get('stack') != shared_stack:
+            manifest = {}
+
+    # Variants made by handle_responsive_images are uploaded with the originals
+    image_dirs = [images_dir]
+    if 'responsive_images' in data:
+        image_dirs.append(tools.get_responsive_images_dir(options))
+    local = get_local_image_etags(image_dirs, manifest.get('local', {}))
+    stale = time.time() - manifest.get('listed', 0) > options.get('image_manifest_ttl', 86400)
+    remote = {} if stale else manifest['remote']
+    changed = sorted(key for key, entry in local.items() if remote.get(key) != entry['etag'])
 
-        if 'aws_profile_name' in data['options']:
-            cmd.extend(['--profile', data['options']['aws_profile_name']])
+    try:
+        if stale:
+            region = options.get('aws_region_name', 'us-east-1')
+            bucket_name = get_stack_outputs(shared_stack, region, options).get('AssetsBucketName')
+            if not bucket_name:
+                print("Warning: Could not fetch AssetsBucketName from stack outputs. Defaulting to 'asyncacademy-assets'.")
+                bucket_name = 'asyncacademy-assets'
+            manifest = {'version': 1, 'stack': shared_stack, 'bucket': bucket_name}
+        bucket_name = manifest['bucket']
+
+        if changed or stale:
+            workers = options.get('upload_workers', 16)
+            s3_client = get_client('s3', options, max_pool_connections=workers, retry_mode='adaptive')
+            if stale:
+                print(f"Listing {bucket_name}...")
+                remote = list_remote_etags(s3_client, bucket_name)
+                manifest['listed'] = time.time()
+                changed = sorted(key for key, entry in local.items() if remote.get(key) != entry['etag'])
+
+            print(f"Syncing {len(changed)} of {len(local)} images to {bucket_name}...")
+            failures = upload_items({key: local[key]['filename'] for key in changed},
+                                    dict(options, s3_bucket=bucket_name), s3_client)
+            for key in set(changed) - set(failures):
+                remote[key] = local[key]['etag']
+            if failures:
+                print(f"Warning: {len(failures)} images failed to upload.")
+        else:
+            print(f"All {len(local)} images in {bucket_name} are up to date.")
 
-        subprocess.check_call(cmd)
+        manifest['local'] = local
+        manifest['remote'] = remote
+        with tools.atomic_write(manifest_path) as f:
+            json.dump(manifest, f)
         print("Sync complete.")
-    except subprocess.CalledProcessError:
-        print("Sync failed. Ensure AWS CLI is installed and configured.")
-        # We don't exit here so the build can continue if offline
-    except FileNotFoundError:
-        print("Warning: 'aws' command not found. Skipping image sync.")
     except Exception as e:
+        # We don't exit here so the build can continue if offline
         print(f"Warning: Image sync failed due to error: {e}")
 
 def perform_shared_deploy(env, stack_name, data):
@@ -381,6 +791,9 @@ def perform_shared_deploy(env, stack_name, data):
     except subprocess.CalledProcessError:
         click.echo("Shared Infrastructure Deploy failed.")
         sys.exit(1)
+    finally:
+        # Even a failed deploy may have changed the stack's outputs
+        forget_stack_outputs(stack_name, data['options'])
 
 def inject_email_templates(env, template_file='template.yaml'):
     """
@@ -510,6 +923,9 @@ def perform_sam_deploy(env, stack_name, data):
     except subprocess.CalledProcessError:
         click.echo("SAM Deploy failed.")
         sys.exit(1)
+    finally:
+        # Even a failed deploy may have changed the stack's outputs
+        forget_stack_outputs(stack_name, data['options'])
 
     # Fetch outputs for API testing
     click.echo("Retrieving Stack Outputs for API testing...")
@@ -526,9 +942,13 @@ def perform_sam_deploy(env, stack_name, data):
         else:
              click.echo("No api_endpoints defined in config, skipping tests.")
 
-def perform_site_deploy(env, config_file, stack_name):
-    """Fetches outputs, builds site, uploads, invalidates, and tests."""
+def perform_site_deploy(env, config_file, stack_name, **overrides):
+    """
+    Fetches outputs, builds site, uploads, invalidates, and tests.
+    Keyword arguments override values in the config's options.
+    """
     data = load_config(config_file)
+    data['options'].update(overrides)
     region = data['options'].get('aws_region_name', 'us-east-1')
 
     click.echo("Retrieving Stack Outputs...")
@@ -556,11 +976,14 @@ def perform_site_deploy(env, config_file, stack_name):
 
     # Build and Upload
     build_site(data)
-    upload_to_s3(data)
+    changed = upload_to_s3(data)
 
-    # Invalidate CloudFront
-    if distribution_id:
-        invalidate_cloudfront(data, distribution_id)
+    # Invalidate only what changed in CloudFront
+    if distribution_id and changed:
+        paths = get_invalidation_paths(changed, data['options'].get('invalidation_max_paths', 15))
+        invalidate_cloudfront(data, distribution_id, paths)
+    elif distribution_id:
+        print("Nothing changed, skipping CloudFront invalidation.")
 
 def custom_test_api_endpoints(endpoints):
     """Tests a list of API endpoints handling POST-only routes."""
@@ -605,16 +1028,91 @@ def cli():
 
 @cli.command()
 @click.option('--config', default='data-dev.yaml', help='Configuration file to use.')
-def build_local(config):
+@click.option('--incremental', is_flag=True, help='Only rebuild pages whose inputs changed.')
+@click.option('--jobs', default=1, type=click.IntRange(min=1), help='Number of processes rendering pages.')
+@click.option('--compress', is_flag=True, help='Write gzip and brotli copies of html, css, js and svg.')
+@click.option('--profile', is_flag=True, help='Report time spent per phase, page and partial.')
+@click.option('--offline', is_flag=True, help='Skip steps that need the network, such as image sync.')
+def build_local(config, incremental, jobs, compress, profile, offline):
     """Builds the website for local development."""
     data = load_config(config)
     data['options']['production'] = False
+    data['options']['incremental'] = incremental
+    data['options']['jobs'] = jobs
+    data['options']['compress'] = compress
+    data['options']['profile'] = profile
+    data['options']['offline'] = offline
+    data['options']['stack_outputs_ttl'] = LOCAL_STACK_OUTPUTS_TTL
+
+    if 'api_url_local' in data['options']:
+         data['options']['api_url'] = data['options']['api_url_local']
+
+    build_site(data)
+
+class RebuildHandler(FileSystemEventHandler):
+    """Collects changed source files until the watch loop picks them up."""
+
+    def __init__(self, ignored):
+        super().__init__()
+        self.ignored = [os.path.abspath(path) + os.sep for path in ignored]
+        self.pending = set()
+        self.lock = threading.Lock()
+
+    def on_any_event(self, event):
+        # Reads during a build produce opened/closed events; only react to writes
+        if event.is_directory or event.event_type not in ('created', 'modified', 'deleted', 'moved'):
+            return
+        for path in (event.src_path, getattr(event, 'dest_path', None)):
+            if path and not any(os.path.abspath(path).startswith(prefix) for prefix in self.ignored):
+                with self.lock:
+                    self.pending.add(path)
+
+    def take(self):
+        with self.lock:
+            pending, self.pending = self.pending, set()
+        return pending
+
+@cli.command()
+@click.option('--config', default='data-dev.yaml', help='Configuration file to use.')
+@click.option('--jobs', default=1, type=click.IntRange(min=1), help='Number of processes rendering pages.')
+@click.option('--offline', is_flag=True, help='Skip steps that need the network, such as image sync.')
+def watch(config, jobs, offline):
+    """Builds the website locally, then rebuilds what changed on every edit."""
+    data = load_config(config)
+    data['options']['production'] = False
+    data['options']['incremental'] = True
+    data['options']['jobs'] = jobs
+    data['options']['offline'] = offline
+    data['options']['stack_outputs_ttl'] = LOCAL_STACK_OUTPUTS_TTL
 
     if 'api_url_local' in data['options']:
          data['options']['api_url'] = data['options']['api_url_local']
 
     build_site(data)
 
+    builder = tools.LiveBuilder(data)
+    handler = RebuildHandler([data['options']['dist'],
+                              tools.get_cache_dir(data['options']),
+                              'email_templates',
+                              '.git'])
+    observer = Observer()
+    observer.schedule(handler, os.getcwd(), recursive=True)
+    observer.start()
+    click.echo('\nWatching for changes. Press Ctrl+C to stop.')
+    try:
+        while True:
+            # Give editors a moment to finish writing before rebuilding
+            time.sleep(0.25)
+            changed = handler.take()
+            if changed:
+                try:
+                    builder.rebuild(changed)
+                except Exception as e:
+                    click.echo(f"Rebuild failed: {e}")
+    except KeyboardInterrupt:
+        observer.stop()
+    observer.join()
+
 @cli.command()
 @click.option('--env', type=click.Choice(['dev', 'prod']), prompt=True, help='Target environment.')
 def sync_images(env):
@@ -671,7 +1169,14 @@ def deploy_infra(env):
 
 @cli.command()
 @click.option('--env', type=click.Choice(['dev', 'prod']), prompt=True, help='Target environment.')
-def deploy_site(env):
+@click.option('--jobs', default=1, type=click.IntRange(min=1), help='Number of processes rendering pages.')
+@click.option('--full-upload', is_flag=True, help='Upload every file, even if unchanged on S3.')
+@click.option('--delete-removed', is_flag=True, help='Delete S3 objects no longer in dist.')
+@click.option('--upload-workers', default=16, type=click.IntRange(min=1), help='Number of concurrent S3 uploads.')
+@click.option('--no-wait', is_flag=True, help="Don't wait for the CloudFront invalidation to complete.")
+@click.option('--compress', is_flag=True, help='Upload html, css, js and svg pre-compressed with Content-Encoding.')
+@click.option('--profile', is_flag=True, help='Report time spent per build phase, page and partial.')
+def deploy_site(env, jobs, full_upload, delete_removed, upload_workers, no_wait, compress, profile):
     """Deploys ONLY the website code (Build -> Upload -> Invalidate)."""
     config_file, stack_name = get_env_details(env)
 
@@ -682,7 +1187,10 @@ def deploy_site(env):
             click.echo(f"Config file for {env} not found.")
             return
 
-    perform_site_deploy(env, config_file, stack_name)
+    perform_site_deploy(env, config_file, stack_name, jobs=jobs,
+                        full_upload=full_upload, delete_removed=delete_removed,
+                        upload_workers=upload_workers, wait_for_invalidation=not no_wait,
+                        compress=compress, profile=profile)
 
 @cli.command(context_settings=dict(ignore_unknown_options=True, allow_extra_args=True))
 @click.option('--env', type=click.Choice(['dev', 'prod']), default='dev', help='Target environment.')
@@ -1,11 +1,42 @@
+import threading
+
 import boto3
+from botocore.config import Config
+
+# Sessions and clients are created once and shared; clients are thread safe,
+# but sessions are not, so creating either happens under the lock
+_sessions = {}
+_clients = {}
+_lock = threading.Lock()
 
-def get_client(service, options):
-    session_args = {}
-    if 'aws_profile_name' in options:
-        session_args['profile_name'] = options['aws_profile_name']
-    if 'aws_region_name' in options:
-        session_args['region_name'] = options['aws_region_name']
+def get_session(options):
+    """Returns the shared boto3 Session for the profile and region in options."""
+    key = (options.get('aws_profile_name'), options.get('aws_region_name'))
+    with _lock:
+        if key not in _sessions:
+            session_args = {}
+            if 'aws_profile_name' in options:
+                session_args['profile_name'] = options['aws_profile_name']
+            if 'aws_region_name' in options:
+                session_args['region_name'] = options['aws_region_name']
+            _sessions[key] = boto3.Session(**session_args)
+        return _sessions[key]
 
-    session = boto3.Session(**session_args)
-    return session.client(service)
+def get_client(service, options, max_pool_connections=None, retry_mode=None):
+    """
+    Returns a client for service, created on first use and then shared by
+    every caller asking for the same profile, region, connection pool size
+    and retry mode. These default to options['aws_max_pool_connections']
+    and options['aws_retry_mode'], or botocore's own defaults.
+    """
+    max_pool_connections = max_pool_connections or options.get('aws_max_pool_connections', 10)
+    retry_mode = retry_mode or options.get('aws_retry_mode')
+    key = (service, options.get('aws_profile_name'), options.get('aws_region_name'),
+           max_pool_connections, retry_mode)
+    session = get_session(options)
+    with _lock:
+        if key not in _clients:
+            config = Config(max_pool_connections=max_pool_connections,
+                            retries={'mode': retry_mode} if retry_mode else None)
+            _clients[key] = session.client(service, config=config)
+        return _clients[key]
@@ -0,0 +1,153 @@
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import tools  # noqa: E402
+
+
+def tokens(source):
+    return [text for text, offset, newline, space in tools.tokenize_js(source)]
+
+
+def decode_vlq(segment):
+    values = []
+    value = shift = 0
+    for char in segment:
+        digit = tools.BASE64_DIGITS.index(char)
+        value += (digit & 31) << shift
+        if digit & 32:
+            shift += 5
+            continue
+        values.append(-(value >> 1) if value & 1 else value >> 1)
+        value = shift = 0
+    return values
+
+
+def decode_mappings(mappings):
+    '''Returns (generated line, generated column, source, line, column)'''
+    segments = []
+    source = line = col = 0
+    for gen_line, text in enumerate(mappings.split(';')):
+        gen_col = 0
+        for segment in filter(None, text.split(',')):
+            values = decode_vlq(segment)
+            gen_col += values[0]
+            source += values[1]
+            line += values[2]
+            col += values[3]
+            segments.append((gen_line, gen_col, source, line, col))
+    return segments
+
+
+# ################### #
+#  REGEX VS DIVISION  #
+# ################### #
+
+
+@pytest.mark.parametrize('source', [
+    'x = a / b / c',
+    'x = (a + b) / 2 / c',
+    'x = a++ / 2 / b',
+    'x = {a: 1} / 2 / b',
+    'x = y[0] / 2 / z',
+])
+def test_division_is_not_a_regex(source):
+    assert tokens(source).count('/') == 2
+
+
+@pytest.mark.parametrize('source, regex', [
+    ('x = / a b /g', '/ a b /g'),
+    ('if (x) / a /.test(s)', '/ a /'),
+    ('while (i) / a /g.exec(s)', '/ a /g'),
+    ('f = x => / a /.test(x)', '/ a /'),
+    ('function f() {}\n/ a /.test(s)', '/ a /'),
+    ('x = /[/]/g', '/[/]/g'),
+    ('x = /https?:\\/\\//', '/https?:\\/\\//'),
+    ('return / a /.test(s)', '/ a /'),
+])
+def test_regex_literal_is_one_token(source, regex):
+    assert regex in tokens(source)
+    assert regex in tools.minify_js(source)[0]
+
+
+# ##### #
+#  ASI  #
+# ##### #
+
+
+@pytest.mark.parametrize('source, minified', [
+    ('a = b\n(c)', 'a=b\n(c)'),
+    ('return\nx', 'return\nx'),
+    ('x = a\n++b', 'x=a\n++b'),
+    ('x = 1 // one\ny = 2', 'x=1\ny=2'),
+    ('x = 1 /* one\n */ y = 2', 'x=1\ny=2'),
+])
+def test_line_breaks_between_tokens_are_kept(source, minified):
+    assert tools.minify_js(source)[0] == minified
+
+
+@pytest.mark.parametrize('source, minified', [
+    ('a + +b', 'a+ +b'),
+    ('a - -b', 'a- -b'),
+    ('var x = typeof y', 'var x=typeof y'),
+])
+def test_tokens_that_would_merge_keep_a_space(source, minified):
+    assert tools.minify_js(source)[0] == minified
+
+
+# ################### #
+#  TEMPLATE LITERALS  #
+# ################### #
+
+
+@pytest.mark.parametrize('source', [
+    '`a  // b  /* c */`',
+    '`line 1\n   line 2`',
+    '`a  ${ b  /* c */ }  d`',
+    '`a ${ `b  ${ c }` } d`',
+    '`a ${ {x: 1}.x } b`',
+])
+def test_template_literals_are_left_as_is(source):
+    assert tools.minify_js(f'x = {source};')[0] == f'x={source};'
+
+
+def test_strings_are_left_as_is():
+    assert tools.minify_js('x = "a // b"  +  \'c /* d */\'')[0] == \
+        'x="a // b"+\'c /* d */\''
+
+
+# ############ #
+#  SOURCE MAP  #
+# ############ #
+
+
+def test_source_map_round_trip(tmp_path):
+    src = tmp_path / 'src'
+    src.mkdir()
+    first = src / 'first.js'
+    first.write_text('// first\nvar  total = 0;\n\nfunction add(n) {\n    total += n;\n}\n')
+    second = src / 'second.js'
+    second.write_text('if (total) /x/.test(s)\nadd( 2 )\n')
+    options = {'dist': str(tmp_path / 'dist'),
+               'cache_dir': str(tmp_path / 'cache')}
+
+    code, source_map = tools.minify_js_bundle([str(first), str(second)],
+                                              'js/bundle.js', options)
+    source_map = json.loads(source_map)
+
+    assert source_map['file'] == 'bundle.js'
+    assert source_map['sources'] == ['../../src/first.js', '../../src/second.js']
+    contents = [first.read_text(), second.read_text()]
+    assert source_map['sourcesContent'] == contents
+
+    generated = code.split('\n')
+    segments = decode_mappings(source_map['mappings'])
+    assert len(segments) == sum(len(tokens(content)) for content in contents)
+    for gen_line, gen_col, source, line, col in segments:
+        original = contents[source].split('\n')[line][col:]
+        token = tokens(original)[0]
+        assert generated[gen_line][gen_col:].startswith(token)
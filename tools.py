@@ -4,13 +4,24 @@ import glob
 import time
 import shutil
 import itertools
-import subprocess
 import json
+import copy
+import functools
+import contextlib
 import re
+import hashlib
+import bisect
+import gzip
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 from jinja2 import BaseLoader
 from jinja2 import Environment
 from jinja2 import DebugUndefined
+from jinja2 import FileSystemBytecodeCache
+from jinja2 import TemplateNotFound
+from jinja2 import Undefined
+from jinja2 import pass_context
+from markupsafe import Markup, escape
 
 import yaml
 import sass
@@ -18,6 +29,21 @@ import mistune
 from mistune.directives import RSTDirective, TableOfContents
 import frontmatter
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
 
 # ####### #
 #  UTILS  #
@@ -30,12 +56,38 @@ class GlobLoader(BaseLoader):
     prepending an exclamation mark. Path expansion with ** works in Python 3.5+
     '''
 
+    # Duplicate basenames already warned about, so rebuilds don't repeat them
+    reported_duplicates = set()
+
     def __init__(self, paths):
         '''
         paths must be a list
         '''
-        files = [self.concat_paths(item) for item in paths]
+        self.paths = paths
+        self.refresh()
+
+    def refresh(self):
+        '''
+        Globs paths again, picking up files added or removed since, and
+        rebuilds the basename index used to look templates up
+        '''
+        files = [self.concat_paths(item) for item in self.paths]
         self.files = list(itertools.chain.from_iterable(files))
+        self.index = {}
+        self.duplicates = {}
+        for item in self.files:
+            basename = os.path.basename(item)
+            if basename in self.index:
+                self.duplicates.setdefault(basename, [self.index[basename]])
+                self.duplicates[basename].append(item)
+            else:
+                self.index[basename] = item
+        for basename, items in self.duplicates.items():
+            if tuple(items) in self.reported_duplicates:
+                continue
+            self.reported_duplicates.add(tuple(items))
+            print(f'Warning: {len(items)} templates named {basename}, '
+                  f'using {items[0]} (also found {", ".join(items[1:])})')
 
     @classmethod
     def concat_paths(cls, paths_to_concat):
@@ -51,7 +103,7 @@ class GlobLoader(BaseLoader):
             cls.append_path_to_list(paths_to_concat,
                                     positive_match,
                                     negative_match)
-        return list(set(positive_match) - set(negative_match))
+        return sorted(set(positive_match) - set(negative_match))
 
     @staticmethod
     def append_path_to_list(path_to_append, positive_match, negative_match):
@@ -63,14 +115,53 @@ class GlobLoader(BaseLoader):
         else:
             positive_match += glob.glob(path_to_append)
 
+    def find(self, template):
+        '''
+        Returns the path of the file matching template, or None
+        '''
+        return self.index.get(template)
+
     def get_source(self, environment, template):
-        for item in self.files:
-            if os.path.basename(item) == template:
-                mtime = os.path.getmtime(item)
-                with open(item, 'r') as f:
-                    return (f.read(),
-                            item,
-                            lambda: mtime == os.path.getmtime(item))
+        item = self.find(template)
+        if item is None:
+            raise TemplateNotFound(template)
+        mtime = os.path.getmtime(item)
+
+        def uptodate():
+            try:
+                return mtime == os.path.getmtime(item)
+            except OSError:
+                return False
+
+        with open(item, 'r') as f:
+            return (f.read(), item, uptodate)
+
+
+class TrackingEnvironment(Environment):
+    '''
+    Environment that records the name of every template requested while
+    rendering. Extends, includes, imports and render_partial all go through
+    get_template, so after a render loaded_templates holds everything the
+    page depended on.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.loaded_templates = set()
+        # Seconds spent in render_partial, keyed by the stack of partials
+        self.partial_times = {}
+        self.partial_stack = []
+
+    def get_template(self, name, *args, **kwargs):
+        if isinstance(name, str):
+            self.loaded_templates.add(name)
+        return super().get_template(name, *args, **kwargs)
+
+    def select_template(self, names, *args, **kwargs):
+        if not isinstance(names, Undefined):
+            self.loaded_templates.update(name for name in names
+                                         if isinstance(name, str))
+        return super().select_template(names, *args, **kwargs)
 
 
 def search_include_paths(target_filename, include_paths):
@@ -81,9 +172,9 @@ def search_include_paths(target_filename, include_paths):
     raise FileNotFoundError(f"Can't find {target_filename}")
 
 
-def concat_files(glob_paths, include_paths=None):
-    '''Takes a list of filenames and combines the contents of those files into
-    one string
+def resolve_files(glob_paths, include_paths=None):
+    '''Takes a list of globs or filenames and returns the matching files, in
+    order, looking in include_paths for names that don't match anything
     '''
     files = []
     for path in glob_paths:
@@ -96,13 +187,130 @@ def concat_files(glob_paths, include_paths=None):
             files.append(search_include_paths(path, include_paths))
         else:
             raise FileNotFoundError("Can't find {0}".format(path))
+    return files
+
+
+def concat_files(glob_paths, include_paths=None):
+    '''Takes a list of filenames and combines the contents of those files into
+    one string
+    '''
     return_string = ''
-    for current_file in files:
+    for current_file in resolve_files(glob_paths, include_paths):
         with open(current_file, 'r') as f:
             return_string += f.read()
     return return_string
 
 
+def get_cache_dir(options):
+    '''Returns the directory used for build caches, creating it if needed'''
+    cache_dir = os.path.expanduser(options.get('cache_dir', '.build-cache'))
+    os.makedirs(cache_dir, exist_ok=True)
+    return cache_dir
+
+
+@contextlib.contextmanager
+def atomic_write(path, mode='w'):
+    '''
+    Opens a temporary file next to path for writing and renames it over path
+    once the block finishes, so readers never see a partly written file.
+    If the block raises, the temporary file is removed and path is untouched.
+    '''
+    tmp_path = f'{path}.tmp{os.getpid()}'
+    try:
+        with open(tmp_path, mode, buffering=1 << 16) as f:
+            yield f
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+_file_hashes = {}
+
+
+def file_hash(path):
+    '''
+    Returns the sha1 of a file's contents, or None if it doesn't exist.
+    Hashes are remembered until the file's mtime or size changes.
+    '''
+    try:
+        stat = os.stat(path)
+    except (OSError, TypeError):
+        return None
+    key = (path, stat.st_mtime_ns, stat.st_size)
+    if key not in _file_hashes:
+        sha1 = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                sha1.update(chunk)
+        _file_hashes[key] = sha1.hexdigest()
+    return _file_hashes[key]
+
+
+_bytecode_caches = {}
+
+
+def get_bytecode_cache(options):
+    '''
+    Returns the on-disk Jinja bytecode cache in the build cache directory.
+    Every environment shares it; entries are keyed by template name and path
+    and checked against a hash of the source.
+    '''
+    directory = os.path.join(get_cache_dir(options), 'jinja')
+    if directory not in _bytecode_caches:
+        os.makedirs(directory, exist_ok=True)
+        _bytecode_caches[directory] = FileSystemBytecodeCache(directory)
+    return _bytecode_caches[directory]
+
+
+def template_from_string(j2_env, source, options):
+    '''
+    Like j2_env.from_string, but the compiled code is stored in the bytecode
+    cache keyed by a hash of source, so unchanged strings skip lexing,
+    parsing and code generation on later builds
+    '''
+    bytecode_cache = get_bytecode_cache(options)
+    digest = hashlib.sha1(source.encode()).hexdigest()
+    bucket = bytecode_cache.get_bucket(j2_env, '<string>', digest, source)
+    if bucket.code is None:
+        bucket.code = j2_env.compile(source)
+        bytecode_cache.set_bucket(bucket)
+    else:
+        # Entries still in use stay the newest, out of prune_bytecode_cache's way
+        path = os.path.join(bytecode_cache.directory,
+                            bytecode_cache.pattern % bucket.key)
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+    return j2_env.template_class.from_code(j2_env, bucket.code,
+                                           j2_env.make_globals(None))
+
+
+def prune_bytecode_cache(options):
+    '''
+    Deletes all but the newest options['jinja_cache_entries'] (default 2000)
+    entries of the bytecode cache. Every edit to a page compiled with
+    template_from_string leaves its old entry behind, so in watch mode the
+    cache would otherwise grow with each save.
+    '''
+    bytecode_cache = get_bytecode_cache(options)
+    entries = []
+    with os.scandir(bytecode_cache.directory) as it:
+        for entry in it:
+            if entry.is_file():
+                entries.append((entry.stat().st_mtime_ns, entry.path))
+    entries.sort(reverse=True)
+    for mtime, path in entries[options.get('jinja_cache_entries', 2000):]:
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+
 def clean(path):
     '''Delete files generated by build script'''
     for root, dirs, files in os.walk(os.path.expanduser(path)):
@@ -115,50 +323,634 @@ def clean(path):
                 shutil.rmtree(os.path.join(root, d))
 
 
-def copy_files(files_to_copy):
+def link_or_copy(src, dst):
+    '''Hard links src to dst, copying it where hard links are not supported'''
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+    return dst
+
+
+def replace_copy(src, dst):
+    '''
+    Copies src to dst through a temporary file, so that a hard link at dst
+    is replaced rather than written through
+    '''
+    with open(src, 'rb') as fsrc, atomic_write(dst, 'wb') as fdst:
+        shutil.copyfileobj(fsrc, fdst)
+    shutil.copystat(src, dst)
+    return dst
+
+
+def get_staging_dir(dist):
+    return f'{os.path.normpath(os.path.expanduser(dist))}.staging'
+
+
+def stage_dist(dist, seed=False):
+    '''
+    Creates an empty staging directory next to dist and returns its path.
+    With seed, the staging directory starts as a copy of dist made of hard
+    links, so unchanged outputs cost nothing. Everything written into it
+    goes through a rename, which leaves the files in dist untouched.
+    '''
+    staging = get_staging_dir(dist)
+    shutil.rmtree(staging, ignore_errors=True)
+    if seed and os.path.isdir(dist):
+        shutil.copytree(dist, staging, symlinks=True,
+                        copy_function=link_or_copy)
+    else:
+        os.makedirs(staging)
+    return staging
+
+
+def staged_path(path, dist, staging):
+    '''Returns path moved into staging if it is inside dist'''
+    rel = os.path.relpath(path, dist)
+    if rel == os.pardir or rel.startswith(os.pardir + os.sep):
+        return path
+    return os.path.normpath(os.path.join(staging, rel))
+
+
+def swap_dist(dist, staging):
+    '''Moves a finished staging directory into place as dist'''
+    dist = os.path.normpath(os.path.expanduser(dist))
+    old = f'{dist}.old'
+    shutil.rmtree(old, ignore_errors=True)
+    if os.path.lexists(dist):
+        os.rename(dist, old)
+    os.rename(staging, dist)
+    shutil.rmtree(old, ignore_errors=True)
+
+
+# Linux ioctl that makes a copy-on-write clone of a file (btrfs, XFS)
+FICLONE = 0x40049409
+
+
+def same_file(src, dst):
+    '''
+    True if dst already holds the contents of src: the same inode, or the
+    same size and mtime, or failing that the same hash
+    '''
+    if os.path.islink(dst):
+        return False
+    try:
+        src_stat, dst_stat = os.stat(src), os.stat(dst)
+    except OSError:
+        return False
+    if (src_stat.st_dev, src_stat.st_ino) == (dst_stat.st_dev, dst_stat.st_ino):
+        return True
+    if src_stat.st_size != dst_stat.st_size:
+        return False
+    if src_stat.st_mtime_ns == dst_stat.st_mtime_ns:
+        return True
+    return file_hash(src) == file_hash(dst)
+
+
+def reflink(src, dst):
+    '''Clones src to dst without copying its data, raising OSError where unsupported'''
+    if fcntl is None:
+        raise OSError('reflinks are not supported on this platform')
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+
+
+def place_file(src, dst):
+    '''
+    Puts src at dst unless dst already matches it, returning True if
+    anything was written. A hard link is tried first, then a reflink, then a
+    byte copy. The new file is made under a temporary name and renamed over
+    dst, so an existing dst is replaced rather than written through.
+    '''
+    if same_file(src, dst):
+        return False
+    tmp_path = f'{dst}.tmp{os.getpid()}'
+    try:
+        try:
+            os.link(src, tmp_path)
+        except OSError:
+            try:
+                reflink(src, tmp_path)
+            except OSError:
+                shutil.copyfile(src, tmp_path)
+            shutil.copystat(src, tmp_path)
+        os.replace(tmp_path, dst)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+    return True
+
+
+def place_symlink(target, link):
+    '''
+    Points the symlink link at target, replacing an existing link. As with
+    ln -s, a link naming an existing directory is made inside it. Returns
+    True if the link changed.
+    '''
+    if os.path.isdir(link) and not os.path.islink(link):
+        link = os.path.join(link, os.path.basename(os.path.normpath(target)))
+    if os.path.islink(link) and os.readlink(link) == target:
+        return False
+    if os.path.isdir(link) and not os.path.islink(link):
+        print(f'Warning: {link} is a directory, not linking {target}')
+        return False
+    tmp_path = f'{link}.tmp{os.getpid()}'
+    os.symlink(target, tmp_path)
+    os.replace(tmp_path, link)
+    return True
+
+
+def copy_files(files_to_copy, workers=8):
+    '''
+    Copies each glob of files or directories into its destination on a pool
+    of threads, skipping files that are already up to date
+    '''
+    t1 = time.time()
+    placements = []
     for dest_path in files_to_copy:
-        if not os.path.exists(dest_path):
-            os.makedirs(dest_path)
-        file_list = GlobLoader(files_to_copy[dest_path]).files
-        for file in file_list:
-            print((f'Copying {os.path.basename(file)} to {dest_path}'
-                   '...'),
-                  end="")
+        os.makedirs(dest_path, exist_ok=True)
+        for file in GlobLoader(files_to_copy[dest_path]).files:
+            target = os.path.join(dest_path, os.path.basename(file))
             if os.path.isfile(file):
-                shutil.copyfile(file, os.path.join(dest_path,
-                                                   os.path.basename(file)))
-                print(' Done!')
+                placements.append((file, target))
             elif os.path.isdir(file):
-                shutil.copytree(file, os.path.join(dest_path,
-                                                   os.path.basename(file)))
-                print(' Done!')
+                for root, dirs, files in os.walk(file, followlinks=True):
+                    dest_root = os.path.join(target, os.path.relpath(root, file))
+                    os.makedirs(dest_root, exist_ok=True)
+                    placements.extend((os.path.join(root, f), os.path.join(dest_root, f))
+                                      for f in files)
 
+    print(f'Copying {len(placements)} files...', end='')
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        written = sum(executor.map(lambda placement: place_file(*placement),
+                                   placements))
+    print(f' Done! {written} changed, {len(placements) - written} unchanged, '
+          f'in {round(float(time.time() - t1), 4)} seconds')
 
 
 def link_static(src, dest):
     print((f'linking {src} to {dest}...'), end='')
-    subprocess.run(['ln', '-s',
-                    os.path.expanduser(src),
-                    os.path.expanduser(dest)])
+    place_symlink(os.path.expanduser(src), os.path.expanduser(dest))
     print(' Done!')
 
 
+# ######## #
+#  ASSETS  #
+# ######## #
+
+
+def write_asset(data, dest_path, content):
+    '''
+    Writes a built asset to dist. With options['fingerprint_assets'] a copy
+    named after a hash of its content is written too, and recorded in
+    options['asset_map'] for asset_url() to find.
+    '''
+    options = data['options']
+    os.makedirs(os.path.join(options['dist'], os.path.split(dest_path)[0]),
+                exist_ok=True)
+    with atomic_write(os.path.join(options['dist'], dest_path)) as f:
+        f.write(content)
+
+    if not options.get('fingerprint_assets'):
+        return
+    digest = hashlib.sha1(content.encode()).hexdigest()[:10]
+    root, ext = os.path.splitext(dest_path)
+    hashed_path = f'{root}.{digest}{ext}'
+    # Earlier builds' copies, and their compressed variants, are left in
+    # dist by incremental builds; whatever isn't the current hash goes
+    directory = os.path.join(options['dist'], os.path.dirname(dest_path))
+    stale = re.compile(re.escape(os.path.basename(root)) + r'\.[0-9a-f]{10}'
+                       + re.escape(ext) + r'(\.gz|\.br)?$')
+    for name in os.listdir(directory):
+        if stale.match(name) and not name.startswith(os.path.basename(hashed_path)):
+            os.unlink(os.path.join(directory, name))
+    with atomic_write(os.path.join(options['dist'], hashed_path)) as f:
+        f.write(content)
+    options.setdefault('asset_map', {})[dest_path] = hashed_path
+
+
+@pass_context
+def asset_url(context, path):
+    '''
+    Returns the URL of a built asset such as css/style.css, pointing at its
+    fingerprinted copy when there is one
+    '''
+    path = path.lstrip('/')
+    if path in context.get('empty_bundles', ()):
+        raise ValueError(f'{path} is empty: all of its sources moved into '
+                         f'{context.get("js_common")}, so drop its <script> tag')
+    return '/' + context.get('asset_map', {}).get(path, path)
+
+
+def get_shared_sources(bundles, min_bundles=2):
+    '''
+    Returns the source files used by at least min_bundles of the bundles, in
+    order of first use
+    '''
+    counts = {}
+    for files in bundles.values():
+        for file in dict.fromkeys(files):
+            counts[file] = counts.get(file, 0) + 1
+    return [file for file, count in counts.items() if count >= min_bundles]
+
+
+def resolve_bundles(data, kind):
+    '''Returns {bundle: [source files]} for the js or scss bundles as configured'''
+    return {dest_path: resolve_files(sources, data[kind]['search'])
+            for dest_path, sources in data[kind]['paths'].items()}
+
+
+def get_common_sources(bundles, min_bundles=2):
+    '''
+    Returns the shared sources that can move into a common chunk without
+    changing the order anything runs in: those that, in every bundle using
+    them, come after only other such sources, in the order the chunk has them
+    '''
+    shared = get_shared_sources(bundles, min_bundles)
+    common = []
+    added = True
+    while added:
+        added = False
+        for file in shared:
+            if file in common:
+                continue
+            if all(all(earlier in common for earlier in files[:files.index(file)])
+                   for files in bundles.values() if file in files):
+                common.append(file)
+                added = True
+    return common
+
+
+def get_bundle_files(data, kind):
+    '''
+    Returns {bundle: [source files]} for the js or scss bundles. If js.common
+    names a common chunk, sources used by js.common_min_bundles (default 2)
+    or more bundles are moved out of them into that chunk, which pages then
+    load once, before the other bundles. Only sources at the start of every
+    bundle using them move, so nothing runs in a different order. Bundles
+    left with no sources, and an empty chunk, are left out; see
+    get_empty_bundles().
+    '''
+    bundles = resolve_bundles(data, kind)
+    common = data[kind].get('common') if kind == 'js' else None
+    if common:
+        shared = get_common_sources(bundles,
+                                    data[kind].get('common_min_bundles', 2))
+        bundles = {dest_path: [file for file in files if file not in shared]
+                   for dest_path, files in bundles.items()}
+        bundles = {dest_path: files for dest_path, files in bundles.items()
+                   if files}
+        if shared:
+            bundles[common] = shared
+    return bundles
+
+
+def get_empty_bundles(data, kind):
+    '''
+    Returns the configured bundles that get_bundle_files() leaves out because
+    all of their sources moved into the common chunk. Pages can't load them.
+    '''
+    bundle_files = get_bundle_files(data, kind)
+    return [dest_path for dest_path in data[kind]['paths']
+            if dest_path not in bundle_files]
+
+
+def report_duplicate_sources(data, kind):
+    '''
+    Prints, for each bundle, how many of its bytes come from sources that
+    other bundles include too, as configured, before any common chunk is
+    split out
+    '''
+    bundles = resolve_bundles(data, kind)
+    shared = set(get_shared_sources(bundles))
+    for dest_path, files in bundles.items():
+        duplicates = [file for file in files if file in shared]
+        if not duplicates:
+            continue
+        duplicate_bytes = sum(os.path.getsize(file) for file in duplicates)
+        total_bytes = sum(os.path.getsize(file) for file in files)
+        print(f'{dest_path}: {duplicate_bytes} of {total_bytes} bytes also in '
+              f'other bundles ({", ".join(map(os.path.basename, duplicates))})')
+
+
 # #### #
 #  JS  #
 # #### #
 
 
+# Bump when minify_js output changes, to invalidate cached results
+JS_MINIFIER_VERSION = 2
+
+JS_PUNCTUATORS = sorted([
+    '>>>=', '...', '===', '!==', '**=', '<<=', '>>=', '>>>', '&&=', '||=',
+    '??=', '=>', '==', '!=', '<=', '>=', '&&', '||', '??', '?.', '++', '--',
+    '+=', '-=', '*=', '/=', '%=', '&=', '|=', '^=', '<<', '>>', '**'
+], key=len, reverse=True)
+
+# A / after these starts a regular expression rather than a division
+JS_KEYWORDS_BEFORE_EXPRESSION = {
+    'return', 'typeof', 'instanceof', 'in', 'of', 'new', 'delete', 'void',
+    'throw', 'case', 'do', 'else', 'yield', 'await'
+}
+
+# A / after the ) of these keywords' conditions starts a regular expression
+JS_CONDITION_KEYWORDS = {'if', 'while', 'for', 'with'}
+
+# A { after these opens a block rather than an object literal, and a / after
+# the } that closes a block starts a regular expression
+JS_BEFORE_BLOCK = {';', '{', '}', ')', '=>', 'else', 'do', 'try', 'finally'}
+
+JS_NUMBER = re.compile(r'''
+    0[xXbBoO][0-9a-fA-F_]+n?
+    | (?:\d[\d_]*\.?[\d_]*|\.\d[\d_]*)(?:[eE][+-]?\d+)?n?
+''', re.VERBOSE)
+JS_WORD = re.compile(r'(?:[\w$\\]|[^\x00-\x7f])+')
+BASE64_DIGITS = ('ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+                 '0123456789+/')
+
+
+def _is_js_word_char(char):
+    return char.isalnum() or char in '_$\\' or ord(char) > 127
+
+
+def _skip_js_string(source, i):
+    '''Returns the index just past the string literal starting at i'''
+    quote = source[i]
+    i += 1
+    while i < len(source) and source[i] != quote and source[i] != '\n':
+        i += 2 if source[i] == '\\' else 1
+    return i + 1
+
+
+def _skip_js_template(source, i):
+    '''Returns the index just past the template literal starting at i'''
+    i += 1
+    while i < len(source) and source[i] != '`':
+        if source[i] == '\\':
+            i += 2
+        elif source.startswith('${', i):
+            depth = 0
+            i += 1
+            while i < len(source):
+                char = source[i]
+                if char in '\'"':
+                    i = _skip_js_string(source, i)
+                    continue
+                if char == '`':
+                    i = _skip_js_template(source, i)
+                    continue
+                if char == '{':
+                    depth += 1
+                elif char == '}':
+                    depth -= 1
+                    if depth == 0:
+                        break
+                i += 1
+            i += 1
+        else:
+            i += 1
+    return i + 1
+
+
+def _skip_js_regex(source, i):
+    '''Returns the index just past the regex literal (and flags) at i'''
+    i += 1
+    in_class = False
+    while i < len(source) and source[i] != '\n':
+        char = source[i]
+        if char == '\\':
+            i += 1
+        elif char == '[':
+            in_class = True
+        elif char == ']':
+            in_class = False
+        elif char == '/' and not in_class:
+            break
+        i += 1
+    i += 1
+    while i < len(source) and _is_js_word_char(source[i]):
+        i += 1
+    return i
+
+
+def tokenize_js(source):
+    '''
+    Yields (text, offset, newline_before, space_before) for every token of
+    source. Whitespace and comments are dropped, except /*! comments.
+    '''
+    i = 0
+    newline = space = False
+    previous = None
+    # Whether each open ( is a condition and each open { is a block
+    parens = []
+    braces = []
+    closed_condition = closed_block = False
+    while i < len(source):
+        char = source[i]
+        if char.isspace():
+            newline = newline or char in '\n\r\u2028\u2029'
+            space = True
+            i += 1
+            continue
+        if source.startswith('//', i):
+            end = source.find('\n', i)
+            i = len(source) if end == -1 else end
+            space = True
+            continue
+        if source.startswith('/*', i) and not source.startswith('/*!', i):
+            end = source.find('*/', i + 2)
+            end = len(source) if end == -1 else end + 2
+            newline = newline or '\n' in source[i:end]
+            space = True
+            i = end
+            continue
+
+        if source.startswith('/*!', i):
+            end = source.find('*/', i + 3)
+            end = len(source) if end == -1 else end + 2
+        elif char in '\'"':
+            end = _skip_js_string(source, i)
+        elif char == '`':
+            end = _skip_js_template(source, i)
+        elif char == '/' and (previous is None
+                              or previous in JS_KEYWORDS_BEFORE_EXPRESSION
+                              or (previous == ')' and closed_condition)
+                              or (previous == '}' and closed_block)
+                              or (not _is_js_word_char(previous[-1])
+                                  and previous[-1] not in ')]}\'"`'
+                                  and previous not in ('++', '--'))):
+            end = _skip_js_regex(source, i)
+        elif char.isdigit() or (char == '.' and source[i + 1:i + 2].isdigit()):
+            end = JS_NUMBER.match(source, i).end()
+        elif _is_js_word_char(char):
+            end = JS_WORD.match(source, i).end()
+        else:
+            end = i + 1
+            for punctuator in JS_PUNCTUATORS:
+                if source.startswith(punctuator, i):
+                    end = i + len(punctuator)
+                    break
+
+        token = source[i:end]
+        if token == '(':
+            parens.append(previous in JS_CONDITION_KEYWORDS)
+        elif token == ')':
+            closed_condition = parens.pop() if parens else False
+        elif token == '{':
+            braces.append(previous is None or previous in JS_BEFORE_BLOCK)
+        elif token == '}':
+            closed_block = braces.pop() if braces else True
+        previous = token
+        yield previous, i, newline, space
+        newline = space = False
+        i = end
+
+
+def _js_needs_space(left, right):
+    '''True if left and right would merge into other tokens unless apart'''
+    if _is_js_word_char(left[-1]) and _is_js_word_char(right[0]):
+        return True
+    if left[-1] in '+-/' and right[0] == left[-1]:
+        return True
+    return left[-1] == '/' and right[0] == '*' or (
+        left[-1].isdigit() and right[0] == '.')
+
+
+def minify_js(source):
+    '''
+    Strips comments and collapses whitespace. Line breaks between tokens are
+    kept, so automatic semicolon insertion behaves exactly as before.
+    Returns the code and a list of (generated line, generated column,
+    original line, original column) for every token.
+    '''
+    line_starts = [0] + [match.end() for match in re.finditer('\n', source)]
+    out = []
+    mappings = []
+    gen_line = gen_col = 0
+    previous = None
+    for text, offset, newline, space in tokenize_js(source):
+        if previous is not None:
+            if newline:
+                out.append('\n')
+                gen_line += 1
+                gen_col = 0
+            elif space and _js_needs_space(previous, text):
+                out.append(' ')
+                gen_col += 1
+        line = bisect.bisect_right(line_starts, offset) - 1
+        mappings.append((gen_line, gen_col, line, offset - line_starts[line]))
+        out.append(text)
+        if '\n' in text:
+            gen_line += text.count('\n')
+            gen_col = len(text) - text.rindex('\n') - 1
+        else:
+            gen_col += len(text)
+        previous = text
+    return ''.join(out), mappings
+
+
+def _vlq(value):
+    value = (-value << 1) | 1 if value < 0 else value << 1
+    encoded = ''
+    while True:
+        digit = value & 31
+        value >>= 5
+        encoded += BASE64_DIGITS[digit | (32 if value else 0)]
+        if not value:
+            return encoded
+
+
+def encode_source_map(file, sources, contents, segments):
+    '''
+    Returns a v3 source map. segments is a sorted list of (generated line,
+    generated column, source index, original line, original column).
+    '''
+    lines = [[]]
+    previous_col = previous_source = previous_line = previous_orig_col = 0
+    for gen_line, gen_col, source, line, col in segments:
+        while len(lines) <= gen_line:
+            lines.append([])
+            previous_col = 0
+        lines[gen_line].append(_vlq(gen_col - previous_col)
+                               + _vlq(source - previous_source)
+                               + _vlq(line - previous_line)
+                               + _vlq(col - previous_orig_col))
+        previous_col, previous_source = gen_col, source
+        previous_line, previous_orig_col = line, col
+    return json.dumps({
+        'version': 3,
+        'file': file,
+        'sources': sources,
+        'sourcesContent': contents,
+        'names': [],
+        'mappings': ';'.join(','.join(line) for line in lines)
+    })
+
+
+def cached_minify_js(source, options):
+    '''minify_js, with results cached by a hash of source'''
+    key = hashlib.sha1(f'{JS_MINIFIER_VERSION}:{source}'.encode()).hexdigest()
+    cache_path = os.path.join(get_cache_dir(options), 'js', f'{key}.json')
+    if os.path.exists(cache_path):
+        with open(cache_path, 'r') as f:
+            cached = json.load(f)
+        return cached['code'], cached['mappings']
+    code, mappings = minify_js(source)
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    with atomic_write(cache_path) as f:
+        json.dump({'code': code, 'mappings': mappings}, f)
+    return code, mappings
+
+
+def minify_js_bundle(files, dest_path, options):
+    '''
+    Minifies and joins files. Returns the bundle and a source map pointing
+    back at the original files, relative to where the map is written.
+    '''
+    map_dir = os.path.dirname(os.path.abspath(
+        os.path.join(options['dist'], f'{dest_path}.map')))
+    parts = []
+    contents = []
+    segments = []
+    line_offset = 0
+    for index, file in enumerate(files):
+        with open(file, 'r') as f:
+            contents.append(f.read())
+        code, mappings = cached_minify_js(contents[-1], options)
+        segments.extend((gen_line + line_offset, gen_col, index, line, col)
+                        for gen_line, gen_col, line, col in mappings)
+        parts.append(code)
+        line_offset += code.count('\n') + 1
+    source_map = encode_source_map(os.path.basename(dest_path),
+                                   [os.path.relpath(os.path.abspath(file), map_dir)
+                                    for file in files],
+                                   contents, segments)
+    return '\n'.join(parts), source_map
+
+
 def handle_js(data, dest_path):
+    '''
+    Bundles the sources of dest_path. With js.minify set in the config, the
+    bundle is minified and a source map is written next to it. When assets
+    are fingerprinted the bundle points at the map's fingerprinted copy, so
+    an immutable bundle never refers to a map that later changes.
+    '''
     t1 = time.time()
     print(f'{time.asctime()} — Generating {dest_path}...', end="")
-    js_string = ''
-    js_string = concat_files(data['js']['paths'][dest_path],
-                             data['js']['search'])
-    os.makedirs(os.path.join(data['options']['dist'],
-                             os.path.split(dest_path)[0]),
-                exist_ok=True)
-    with open(os.path.join(data['options']['dist'], dest_path), 'w') as f:
-        f.write(js_string)
+    files = get_bundle_files(data, 'js')[dest_path]
+    if data['js'].get('minify'):
+        js_string, source_map = minify_js_bundle(files, dest_path,
+                                                 data['options'])
+        map_dest = f'{dest_path}.map'
+        write_asset(data, map_dest, source_map)
+        map_url = data['options'].get('asset_map', {}).get(map_dest, map_dest)
+        js_string += f'\n//# sourceMappingURL={os.path.basename(map_url)}\n'
+    else:
+        js_string = concat_files(files)
+    write_asset(data, dest_path, js_string)
     print(' Done in {0} seconds'.format(round(float(time.time() - t1), 4)))
 
 
@@ -167,17 +959,76 @@ def handle_js(data, dest_path):
 # ###### #
 
 
+SCSS_IMPORT = re.compile(r'''@(import|use|forward)\s+['"]''')
+
+
+def get_scss_cache_path(scss_string, data):
+    '''
+    Returns where the css compiled from scss_string is cached, keyed by the
+    input, the compiler options and the libsass version. Returns None if the
+    input pulls in other files, since their contents aren't part of the key.
+    '''
+    if SCSS_IMPORT.search(scss_string):
+        return None
+    key = hashlib.sha1()
+    key.update(json.dumps([sass.__version__, data['scss'].get('options', {})],
+                          sort_keys=True).encode())
+    key.update(scss_string.encode())
+    return os.path.join(get_cache_dir(data['options']), 'scss',
+                        f'{key.hexdigest()}.css')
+
+
+def compile_scss(scss_string, compile_options):
+    return sass.compile(string=scss_string, **compile_options)
+
+
 def handle_scss(data, dest_path):
+    handle_scss_bundles(data, [dest_path])
+
+
+def handle_scss_bundles(data, dest_paths):
+    '''
+    Writes the css for each bundle in dest_paths. Bundles whose input was
+    compiled before come from the cache; the rest are compiled in parallel.
+    '''
     t1 = time.time()
-    print(f'{time.asctime()} — Generating {dest_path}...', end="")
-    scss_string = concat_files(data['scss']['paths'][dest_path],
-                               data['scss']['search'])
-    os.makedirs(os.path.join(data['options']['dist'],
-                             os.path.split(dest_path)[0]),
-                exist_ok=True)
-    with open(os.path.join(data['options']['dist'], dest_path), 'w') as f:
-        f.write(sass.compile(string=scss_string))
-    print(' Done in {0} seconds'.format(round(float(time.time() - t1), 4)))
+    compile_options = data['scss'].get('options', {})
+    cache_paths = {}
+    to_compile = {}
+    for dest_path in dest_paths:
+        scss_string = concat_files(data['scss']['paths'][dest_path],
+                                   data['scss']['search'])
+        cache_paths[dest_path] = get_scss_cache_path(scss_string, data)
+        if (cache_paths[dest_path] is None
+                or not os.path.exists(cache_paths[dest_path])):
+            to_compile[dest_path] = scss_string
+
+    if len(to_compile) > 1:
+        workers = min(len(to_compile), os.cpu_count() or 1)
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            compiled = dict(zip(to_compile,
+                                executor.map(compile_scss,
+                                             to_compile.values(),
+                                             itertools.repeat(compile_options))))
+    else:
+        compiled = {dest_path: compile_scss(scss_string, compile_options)
+                    for dest_path, scss_string in to_compile.items()}
+
+    for dest_path in dest_paths:
+        cache_path = cache_paths[dest_path]
+        if dest_path in compiled:
+            css = compiled[dest_path]
+            if cache_path is not None:
+                os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+                with atomic_write(cache_path) as f:
+                    f.write(css)
+        else:
+            with open(cache_path, 'r') as f:
+                css = f.read()
+        write_asset(data, dest_path, css)
+        print(f'{time.asctime()} — Generated {dest_path}'
+              f'{"" if dest_path in compiled else " from cache"}')
+    print(f'Done in {round(float(time.time() - t1), 4)} seconds')
 
 # ######## #
 #  IMAGES  #
@@ -195,14 +1046,211 @@ def handle_images(options):
     os.makedirs(image_dest, exist_ok=True) # Ensure dist exists
 
     print((f'linking {local_images} to {image_dest}...'), end='')
-    # We want to link images INTO dist, i.e. dist/images -> local_images
-    # But current code does 'ln -s source dest'.
-    # If dest exists as dir, it makes dest/source.
-    # If dest is 'dist', it makes 'dist/images'. Correct.
-    subprocess.run(['ln', '-s', local_images, image_dest])
+    # Links images INTO dist, i.e. dist/images -> local_images
+    place_symlink(local_images, image_dest)
     print(' Done!')
 
 
+IMAGE_PIPELINE_VERSION = 1
+RESPONSIVE_IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp')
+
+
+def make_image_variant(src, dest, width, fmt, quality):
+    '''Writes src, scaled down to width, to dest in fmt'''
+    with Image.open(src) as original:
+        image = ImageOps.exif_transpose(original)
+        if image.width > width:
+            image = image.resize((width, round(image.height * width / image.width)),
+                                 Image.LANCZOS)
+        if fmt == 'jpeg':
+            image = image.convert('RGB')
+        elif image.mode not in ('RGB', 'RGBA'):
+            transparent = 'A' in image.getbands() or 'transparency' in image.info
+            image = image.convert('RGBA' if transparent else 'RGB')
+        with atomic_write(dest, 'wb') as f:
+            image.save(f, format=fmt.upper(), quality=quality)
+    return dest
+
+
+def get_image_size(src):
+    '''
+    Returns the width and height src is displayed at, read from its header
+    and EXIF orientation without decoding the pixels
+    '''
+    with Image.open(src) as image:
+        width, height = image.size
+        # Orientations 5 to 8 are turned a quarter, swapping the sides
+        if image.getexif().get(0x0112) in (5, 6, 7, 8):
+            width, height = height, width
+    return width, height
+
+
+def get_responsive_images_dir(options):
+    '''
+    Returns the build directory that holds the image variants, laid out as
+    they are keyed in the assets bucket
+    '''
+    return os.path.join(get_cache_dir(options), 'responsive')
+
+
+def handle_responsive_images(data):
+    '''
+    Makes copies of the images in options['images'] scaled down to each of
+    responsive_images.widths, in each of responsive_images.formats, under
+    responsive_images.dest in get_responsive_images_dir, which the image sync
+    uploads alongside images. The images directory itself is never written.
+    Variants are cached by a hash of their source and parameters, so each is
+    only ever made once, and missing ones are made in parallel processes.
+    Sizes and hashes of unchanged sources are remembered between builds.
+    What was made is recorded in options['image_variants'] for srcset() and
+    picture().
+    '''
+    options = data['options']
+    config = data['responsive_images']
+    images_dir = options['images']
+    if Image is None:
+        print('Pillow is not installed. Skipping responsive images.')
+        return
+    if not os.path.isdir(images_dir):
+        print(f'Warning: {images_dir} does not exist. Skipping responsive images.')
+        return
+
+    t1 = time.time()
+    widths = sorted(config.get('widths', [480, 960, 1600]))
+    quality = config.get('quality', 80)
+    dest_name = config.get('dest', 'responsive')
+    variants_dir = get_responsive_images_dir(options)
+    cache_dir = os.path.join(get_cache_dir(options), 'images')
+    os.makedirs(cache_dir, exist_ok=True)
+
+    Image.init()
+    formats = []
+    for fmt in config.get('formats', ['webp']):
+        fmt = 'jpeg' if fmt.lower() == 'jpg' else fmt.lower()
+        if fmt.upper() in Image.SAVE:
+            formats.append(fmt)
+        else:
+            print(f'Warning: Pillow cannot write {fmt} here. Skipping it.')
+
+    sources_path = os.path.join(cache_dir, 'sources.json')
+    previous_sources = {}
+    if os.path.exists(sources_path):
+        try:
+            with open(sources_path) as f:
+                previous_sources = json.load(f)
+        except ValueError:
+            pass
+    known_sources = {}
+
+    variants = {}
+    to_make = {}
+    placements = {}
+    cached = 0
+    for src in sorted(glob.glob(os.path.join(images_dir, '**', '*'), recursive=True)):
+        path = os.path.relpath(src, images_dir).replace(os.sep, '/')
+        if not path.lower().endswith(RESPONSIVE_IMAGE_EXTENSIONS):
+            continue
+        stat = os.stat(src)
+        info = previous_sources.get(path)
+        if not (info and info['size'] == stat.st_size and info['mtime'] == stat.st_mtime_ns):
+            width, height = get_image_size(src)
+            info = {'size': stat.st_size, 'mtime': stat.st_mtime_ns,
+                    'hash': file_hash(src), 'width': width, 'height': height}
+        known_sources[path] = info
+        width, height = info['width'], info['height']
+        ext = os.path.splitext(path)[1].lower().lstrip('.')
+        sources = {}
+        for fmt in formats:
+            sources[fmt] = []
+            for variant_width in [w for w in widths if w < width] + [width]:
+                if variant_width == width and {'jpg': 'jpeg'}.get(ext, ext) == fmt:
+                    # The original already is this variant
+                    sources[fmt].append([width, path])
+                    continue
+                variant_ext = 'jpg' if fmt == 'jpeg' else fmt
+                key = hashlib.sha1(f'{IMAGE_PIPELINE_VERSION}:{info["hash"]}:{variant_width}:'
+                                   f'{fmt}:{quality}'.encode()).hexdigest()
+                cache_path = os.path.join(cache_dir, f'{key}.{variant_ext}')
+                # The original's extension keeps photo.jpg and photo.png apart
+                variant_path = f'{dest_name}/{path}-{variant_width}.{variant_ext}'
+                if os.path.exists(cache_path):
+                    cached += 1
+                else:
+                    to_make[cache_path] = (src, variant_width, fmt)
+                placements[os.path.join(variants_dir, variant_path)] = cache_path
+                sources[fmt].append([variant_width, variant_path])
+        variants[path] = {'width': width, 'height': height, 'sources': sources}
+
+    print(f'{time.asctime()} — Making {len(to_make)} image variants, '
+          f'{cached} cached...', end='')
+    if len(to_make) > 1:
+        with ProcessPoolExecutor() as executor:
+            futures = [executor.submit(make_image_variant, src, cache_path, width, fmt, quality)
+                       for cache_path, (src, width, fmt) in to_make.items()]
+            for future in futures:
+                future.result()
+    else:
+        for cache_path, (src, width, fmt) in to_make.items():
+            make_image_variant(src, cache_path, width, fmt, quality)
+
+    for variant_path, cache_path in placements.items():
+        os.makedirs(os.path.dirname(variant_path), exist_ok=True)
+        place_file(cache_path, variant_path)
+    # Variants of removed images or old settings; nothing else lives here
+    for root, dirs, files in os.walk(variants_dir):
+        for f in files:
+            if os.path.join(root, f) not in placements:
+                os.unlink(os.path.join(root, f))
+    # Cached encodings of old versions of the sources
+    in_use = set(placements.values())
+    for f in os.listdir(cache_dir):
+        cache_path = os.path.join(cache_dir, f)
+        if re.match(r'[0-9a-f]{40}\.', f) and cache_path not in in_use:
+            os.unlink(cache_path)
+
+    with atomic_write(sources_path) as f:
+        json.dump(known_sources, f)
+    options['image_variants'] = variants
+    print(' Done in {0} seconds'.format(round(float(time.time() - t1), 4)))
+
+
+@pass_context
+def srcset(context, path, fmt=None):
+    '''
+    Returns a srcset listing the scaled copies of the image at path in fmt,
+    the first configured format by default, or '' if it has none
+    '''
+    variant = context.get('image_variants', {}).get(path.lstrip('/'))
+    if not variant or not variant['sources']:
+        return ''
+    urls = variant['sources'].get(fmt) if fmt else next(iter(variant['sources'].values()))
+    images_url = context.get('images_url') or ''
+    return ', '.join(f'{images_url}/{url} {width}w' for width, url in urls or [])
+
+
+@pass_context
+def picture(context, path, alt='', sizes='100vw', **attrs):
+    '''
+    Returns a <picture> offering each responsive format of the image at path,
+    falling back to an <img> of the original. Extra keyword arguments become
+    attributes of the <img>, with underscores turned into hyphens.
+    '''
+    path = path.lstrip('/')
+    variant = context.get('image_variants', {}).get(path)
+    images_url = context.get('images_url') or ''
+    markup = ['<picture>']
+    if variant:
+        for fmt in variant['sources']:
+            markup.append(f'<source type="image/{fmt}" srcset="{escape(srcset(context, path, fmt))}" '
+                          f'sizes="{escape(sizes)}">')
+        attrs = dict({'width': variant['width'], 'height': variant['height']}, **attrs)
+    attributes = ''.join(f' {name.rstrip("_").replace("_", "-")}="{escape(value)}"'
+                         for name, value in attrs.items())
+    markup.append(f'<img src="{escape(images_url)}/{escape(path)}" alt="{escape(alt)}"{attributes}>')
+    markup.append('</picture>')
+    return Markup(''.join(markup))
+
+
 # ######### #
 #   AUDIO   #
 # ######### #
@@ -214,28 +1262,314 @@ def handle_audio(options):
                                     options['audio'])
         image_dest = options['dist']
         print((f'linking {local_images} to {image_dest}...'), end='')
-        subprocess.run(['ln', '-s', local_images, image_dest])
+        place_symlink(local_images, image_dest)
     print(' Done!')
 
 
+# ########### #
+#  PROFILING  #
+# ########### #
+
+
+class BuildProfiler:
+    '''
+    Records wall and CPU time for each build phase, and render time for each
+    page and render_partial call, then writes a JSON report and a folded
+    stack file that flame graph tools can read
+    '''
+
+    def __init__(self):
+        self.phases = []
+        self.pages = []
+
+    @staticmethod
+    def cpu_time():
+        # Includes finished worker processes, e.g. parallel page renders
+        times = os.times()
+        return (times.user + times.system
+                + times.children_user + times.children_system)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        wall = time.perf_counter()
+        cpu = self.cpu_time()
+        try:
+            yield
+        finally:
+            self.phases.append({'name': name,
+                                'wall': time.perf_counter() - wall,
+                                'cpu': self.cpu_time() - cpu})
+
+    def record_page(self, page, seconds, partial_times):
+        self.pages.append({'src': page['src'],
+                           'dest': page['dest'],
+                           'seconds': seconds,
+                           'partials': {';'.join(stack): partial_seconds
+                                        for stack, partial_seconds
+                                        in partial_times.items()}})
+
+    def partial_totals(self):
+        '''
+        Returns {partial: [pages, seconds]} across all pages, counting only
+        time spent in the partial itself, not in partials it renders
+        '''
+        totals = {}
+        for page in self.pages:
+            for stack, seconds in self.self_times(page).items():
+                if stack:
+                    name = stack.split(';')[-1]
+                    total = totals.setdefault(name, [0, 0])
+                    total[0] += 1
+                    total[1] += seconds
+        return totals
+
+    @staticmethod
+    def self_times(page):
+        '''
+        Returns {stack: seconds} for page, with each stack's time excluding
+        its children. The page itself is the empty stack.
+        '''
+        inclusive = dict(page['partials'])
+        inclusive[''] = page['seconds']
+        self_times = dict(inclusive)
+        for stack, seconds in inclusive.items():
+            if stack:
+                parent = stack.rpartition(';')[0]
+                self_times[parent] = self_times.get(parent, 0) - seconds
+        return {stack: max(seconds, 0)
+                for stack, seconds in self_times.items()}
+
+    def write(self, options):
+        '''Writes profile.json and profile.folded to the build cache'''
+        cache_dir = get_cache_dir(options)
+        json_path = os.path.join(cache_dir, 'profile.json')
+        with open(json_path, 'w') as f:
+            json.dump({'phases': self.phases,
+                       'pages': self.pages,
+                       'partials': self.partial_totals()}, f, indent=1)
+
+        folded_path = os.path.join(cache_dir, 'profile.folded')
+        page_seconds = sum(page['seconds'] for page in self.pages)
+        with open(folded_path, 'w') as f:
+            for phase in self.phases:
+                seconds = phase['wall']
+                if phase['name'] == 'html':
+                    seconds = max(seconds - page_seconds, 0)
+                f.write(f'build;{phase["name"]} {int(seconds * 1e6)}\n')
+            for page in self.pages:
+                for stack, seconds in self.self_times(page).items():
+                    frames = ';'.join(filter(None, ['build', 'html',
+                                                    page['src'], stack]))
+                    f.write(f'{frames} {int(seconds * 1e6)}\n')
+        print(f'Wrote {json_path} and {folded_path}')
+
+    def print_summary(self, top=10):
+        print('Phase                  wall (s)   cpu (s)')
+        for phase in self.phases:
+            print(f'{phase["name"]:<20} {phase["wall"]:>10.4f} '
+                  f'{phase["cpu"]:>9.4f}')
+        if self.pages:
+            print(f'\nSlowest {top} pages:')
+            for page in sorted(self.pages, key=lambda page: page['seconds'],
+                               reverse=True)[:top]:
+                print(f'{page["seconds"]:>10.4f}  {page["src"]}')
+        partials = self.partial_totals()
+        if partials:
+            print(f'\nSlowest {top} partials (own time, all pages):')
+            for name, (calls, seconds) in sorted(
+                    partials.items(), key=lambda item: item[1][1],
+                    reverse=True)[:top]:
+                print(f'{seconds:>10.4f}  {name} (on {calls} pages)')
+
+
+# ########### #
+#  COMPRESS   #
+# ########### #
+
+
+COMPRESSIBLE_EXTENSIONS = ('.html', '.css', '.js', '.svg')
+
+
+def is_encoding_fresh(path, encoded_path):
+    '''
+    Whether encoded_path was compressed from the current path. Encodings carry
+    the mtime of the file they came from; a newer or older one means it was
+    replaced. ctime can't tell, as seeding the staging dir hard links both.
+    '''
+    try:
+        return os.stat(encoded_path).st_mtime_ns == os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return False
+
+
+def compress_file(path):
+    '''
+    Writes path.gz, and path.br if brotli is installed, unless they are
+    already fresh. Returns the sizes of the original and each encoding.
+    '''
+    sizes = {'original': os.path.getsize(path)}
+    encoders = [('gz', lambda raw: gzip.compress(raw, 9, mtime=0))]
+    if brotli is not None:
+        encoders.append(('br', lambda raw: brotli.compress(raw)))
+
+    raw = None
+    for ext, encode in encoders:
+        encoded_path = f'{path}.{ext}'
+        if not is_encoding_fresh(path, encoded_path):
+            if raw is None:
+                with open(path, 'rb') as f:
+                    raw = f.read()
+            stat = os.stat(path)
+            with atomic_write(encoded_path, 'wb') as f:
+                f.write(encode(raw))
+            os.utime(encoded_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        sizes[ext] = os.path.getsize(encoded_path)
+    return sizes
+
+
+def compress_dist(options):
+    '''
+    Pre-compresses html, css, js and svg in dist in parallel processes and
+    reports the bytes saved. Symlinked files and directories are skipped.
+    '''
+    t1 = time.time()
+    paths = []
+    for root, dirs, files in os.walk(options['dist']):
+        for f in files:
+            path = os.path.join(root, f)
+            if f.endswith(COMPRESSIBLE_EXTENSIONS) and not os.path.islink(path):
+                paths.append(path)
+    if brotli is None:
+        print('brotli is not installed, writing gzip only')
+
+    totals = {}
+    with ProcessPoolExecutor() as executor:
+        for sizes in executor.map(compress_file, paths, chunksize=16):
+            for key, size in sizes.items():
+                totals[key] = totals.get(key, 0) + size
+
+    original = totals.get('original', 0)
+    for ext in ('gz', 'br'):
+        if ext in totals and original:
+            print(f'{ext}: {original} -> {totals[ext]} bytes '
+                  f'({round(100 * (1 - totals[ext] / original), 1)}% smaller)')
+    print(f'Compressed {len(paths)} files in '
+          f'{round(float(time.time() - t1), 4)} seconds')
+
+
+# ########## #
+#  MANIFEST  #
+# ########## #
+
+
+class BuildManifest:
+    '''
+    Records, per output file, the inputs that produced it: the source page,
+    a hash of the data it was rendered with and every template it loaded.
+    On the next build, pages whose inputs are all unchanged can be skipped.
+    '''
+
+    def __init__(self, options):
+        self.path = os.path.join(get_cache_dir(options), 'manifest.json')
+        self.dist = options['dist']
+        self.previous = {}
+        self.current = {}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, 'r') as f:
+                    self.previous = json.load(f).get('pages', {})
+            except (OSError, ValueError) as e:
+                print(f'Warning: ignoring build manifest {self.path}: {e}')
+
+    @staticmethod
+    def data_hash(page):
+        '''Hashes the front matter and global options a page renders with'''
+        data = json.dumps(page['data'], sort_keys=True, default=str)
+        return hashlib.sha1(data.encode()).hexdigest()
+
+    def is_fresh(self, page, data_hash, loader):
+        '''
+        True if page was built before from identical inputs and its output
+        still exists
+        '''
+        entry = self.previous.get(page['dest'])
+        if entry is None:
+            return False
+        if (entry['src'] != page['src']
+                or entry['template'] != page.get('template')
+                or entry['data'] != data_hash
+                or entry['src_hash'] != file_hash(page['src'])):
+            return False
+        if not os.path.exists(os.path.join(self.dist, page['dest'])):
+            return False
+        return all(file_hash(loader.find(name)) == digest
+                   for name, digest in entry['templates'].items())
+
+    def keep(self, page):
+        '''Carries the previous entry for an unchanged page forward'''
+        self.current[page['dest']] = self.previous[page['dest']]
+
+    def record(self, page, data_hash, templates, loader):
+        self.current[page['dest']] = {
+            'src': page['src'],
+            'template': page.get('template'),
+            'data': data_hash,
+            'src_hash': file_hash(page['src']),
+            'templates': {name: file_hash(loader.find(name))
+                          for name in sorted(templates)}
+        }
+
+    def remove_stale(self):
+        '''Deletes outputs of pages that no longer exist, and their .gz/.br'''
+        for dest in sorted(set(self.previous) - set(self.current)):
+            path = os.path.join(self.dist, dest)
+            if os.path.isfile(path):
+                print(f'Removing stale {dest}')
+                os.unlink(path)
+            for encoded_path in (f'{path}.gz', f'{path}.br'):
+                if os.path.isfile(encoded_path):
+                    os.unlink(encoded_path)
+
+    def save(self):
+        with atomic_write(self.path) as f:
+            json.dump({'version': 1, 'pages': self.current}, f, indent=1)
+
+
 # ###### #
 #  HTML  #
 # ###### #
 
 
+_markdown = None
+
+
+@functools.lru_cache(maxsize=1024)
 def markdown_filter(text):
-    markdown = mistune.create_markdown(
-        escape=False,
-        plugins=[RSTDirective([TableOfContents()])]
-    )
-    return markdown(text)
+    '''
+    Renders markdown with a single shared parser. Output is memoized on the
+    text, so blocks repeated across pages are only rendered once per build.
+    '''
+    global _markdown
+    if _markdown is None:
+        _markdown = mistune.create_markdown(
+            escape=False,
+            plugins=[RSTDirective([TableOfContents()])]
+        )
+    return _markdown(text)
 
 
-def get_j2_env(pageset):
+def get_j2_env(pageset, options=None):
     template_files = [pageset[pathset] for pathset in pageset
                       if pathset in ['partials', 'layouts']]
-    j2_env = Environment(loader=GlobLoader(template_files), trim_blocks=True)
+    j2_env = TrackingEnvironment(
+        loader=GlobLoader(template_files),
+        trim_blocks=True,
+        bytecode_cache=get_bytecode_cache(options or {})
+    )
     j2_env.filters['markdown'] = markdown_filter
+    j2_env.globals['asset_url'] = asset_url
+    j2_env.globals['srcset'] = srcset
+    j2_env.globals['picture'] = picture
 
     # Custom function to render a partial with specific context
     def render_partial(template_name, context=None, parent_context=None):
@@ -270,7 +1604,15 @@ def get_j2_env(pageset):
 
             final_context.update(context)
 
-            return template.render(final_context)
+            start = time.perf_counter()
+            j2_env.partial_stack.append(template_name)
+            try:
+                return template.render(final_context)
+            finally:
+                stack = tuple(j2_env.partial_stack)
+                j2_env.partial_times[stack] = (j2_env.partial_times.get(stack, 0)
+                                               + time.perf_counter() - start)
+                j2_env.partial_stack.pop()
         except Exception as e:
             return f"<!-- Error rendering partial {template_name}: {e} -->"
 
@@ -290,51 +1632,64 @@ def get_destination(page, dest, file_ext=True):
         return os.path.join(dest, f'{final_name}.html')
 
 
-def get_nav_pages(files, options):
+def get_nav_pages(pages):
+    '''
+    Returns nav entries for the pages marked nav_item, sorted by order. Takes
+    the records from get_pages, so sources are not read a second time.
+    '''
     nav_pages = []
 
-    for fileset in files:
-        fileset_pages = []
-        if isinstance(fileset['src'], str):
-            fileset_pages.append(fileset['src'])
-        elif isinstance(fileset['src'], list):
-            current_pages = GlobLoader.concat_paths(fileset['src'])
-            for glob_page in current_pages:
-                fileset_pages.append(glob_page)
-        for page_name in fileset_pages:
-            page = {'src': page_name,
-                    'dest': get_destination(page_name, fileset['dest'], False)}
-            set_page_metadata(page)
-            if page['data'].get('nav_item'):
-                (print("yes nav: ", page['src']))
-                nav_data = {}
-                nav_data['title'] = page['data'].get('title')
-                nav_data['dest'] = page.get('dest')
-                nav_data['order'] = page['data'].get('order')
-                nav_data['subtitle'] = page['data'].get('subtitle')
-                nav_data['nav_category'] = page['data'].get('nav_category')
-                nav_pages.append(nav_data)
+    for page in pages:
+        if page['data'].get('nav_item'):
+            (print("yes nav: ", page['src']))
+            nav_data = {}
+            nav_data['title'] = page['data'].get('title')
+            nav_data['dest'] = os.path.splitext(page['dest'])[0]
+            nav_data['order'] = page['data'].get('order')
+            nav_data['subtitle'] = page['data'].get('subtitle')
+            nav_data['nav_category'] = page['data'].get('nav_category')
+            nav_pages.append(nav_data)
 
     nav_pages = sorted(nav_pages, key=lambda x: x['order'])
     return nav_pages
 
 
+_page_metadata = {}
+
+
 def set_page_metadata(page, index=False):
     '''
-    Sets metadata, including dest, content, data
+    Sets metadata, including dest, content, data. Parsed files are remembered
+    until their mtime changes; each page gets its own copy of the data.
     '''
-    if page['src'].endswith('.yaml'):
-        with open(page['src'], 'r') as f:
-            page['data'] = yaml.load(f, Loader=yaml.SafeLoader)
-
-    elif page['src'].endswith('.md') or page['src'].endswith('.html'):
-        fm_page = frontmatter.load(page['src'])
-        page['data'] = fm_page.metadata
-        # if not index:
-        page['content'] = fm_page.content
+    try:
+        mtime = os.stat(page['src']).st_mtime_ns
+    except OSError:
+        mtime = None
+    cached = _page_metadata.get(page['src'])
+    if cached is None or cached[0] != mtime:
+        cached = (mtime, parse_page_metadata(page['src']))
+        _page_metadata[page['src']] = cached
+    page.update(copy.deepcopy(cached[1]))
+
+
+def parse_page_metadata(src):
+    '''
+    Returns a dict with the data (and content, for .md and .html) of src
+    '''
+    metadata = {}
+    if src.endswith('.yaml'):
+        with open(src, 'r') as f:
+            metadata['data'] = yaml.load(f, Loader=yaml.SafeLoader)
+
+    elif src.endswith('.md') or src.endswith('.html'):
+        fm_page = frontmatter.load(src)
+        metadata['data'] = fm_page.metadata
+        metadata['content'] = fm_page.content
     else:
-        print(f"{page['src']} must be in either .yaml,"
+        print(f"{src} must be in either .yaml,"
               ' .md or .html (jinja2) format!')
+    return metadata
 
 
 def get_page(src, dest, template):
@@ -347,7 +1702,8 @@ def get_page(src, dest, template):
 
 def get_pages(files, options):
     '''
-    Returns a list containing one or more dicts of page data
+    Returns a list containing one or more dicts of page data. Each source is
+    globbed and parsed once; the same records feed the nav and the build.
     '''
     if isinstance(files, dict):
         files = [files]
@@ -365,34 +1721,122 @@ def get_pages(files, options):
     return pages
 
 
-def build_page(page, j2_env, options):
-
-    page_time = time.time()
-    print(f'{time.asctime()} — Building {page["src"]}...', end='')
-
+def render_page(page, j2_env, options):
+    '''
+    Renders page to dist. Returns the names of the templates it loaded and
+    the time spent in each stack of render_partial calls.
+    The page is streamed to a temporary file as it renders rather than built
+    up as one string, and only replaces the old page once it is complete.
+    '''
+    j2_env.loaded_templates = set()
+    j2_env.partial_times = {}
     if 'content' in page:
-        final_page = j2_env.from_string(page['content']).render(page['data'])
+        template = template_from_string(j2_env, page['content'], options)
     else:
         template = j2_env.get_template(page['template'])
-        final_page = template.render(page['data'])
 
     local_path = os.path.join(options['dist'], os.path.dirname(page['dest']))
     os.makedirs(local_path, exist_ok=True)
 
-    with open(os.path.join(options['dist'], page['dest']), 'w') as f:
-        f.write(final_page)
+    with atomic_write(os.path.join(options['dist'], page['dest'])) as f:
+        template.stream(page['data']).dump(f)
+    return j2_env.loaded_templates, j2_env.partial_times
+
+
+def build_page(page, j2_env, options):
+    '''
+    Renders page, returning the templates it loaded, the seconds it took and
+    its partial timings
+    '''
+
+    page_time = time.time()
+    print(f'{time.asctime()} — Building {page["src"]}...', end='')
+    templates, partial_times = render_page(page, j2_env, options)
+    seconds = time.time() - page_time
     print(f' Done writing {page["dest"]} in '
-          f'{round(float(time.time() - page_time), 4)} seconds')
+          f'{round(float(seconds), 4)} seconds')
+    return templates, seconds, partial_times
 
 
-def build_pageset(pageset, options):
-    '''Logic for building pages.'''
+_worker_j2_env = None
 
-    if pageset['options'].get('nav'):
-        nav_pages = get_nav_pages(pageset['files'], options)
+
+def _init_render_worker(pageset, options):
+    global _worker_j2_env
+    _worker_j2_env = get_j2_env(pageset, options)
+
+
+def build_pages_serial(pages, j2_env, options):
+    '''
+    Renders pages one after another in this process. As with
+    build_pages_parallel, a failed page is reported and the rest still
+    build. Returns what build_page would for each page, with None for pages
+    that failed, and the number of failures.
+    '''
+    results = []
+    failures = 0
+    for page in pages:
+        try:
+            results.append(build_page(page, j2_env, options))
+        except Exception as e:
+            print(f'\n{time.asctime()} — Failed {page["src"]}: '
+                  f'{type(e).__name__}: {e}')
+            failures += 1
+            results.append(None)
+    return results, failures
+
+
+def _render_in_worker(page, options):
+    page_time = time.time()
+    try:
+        templates, partial_times = render_page(page, _worker_j2_env, options)
+    except Exception as e:
+        return None, f'{type(e).__name__}: {e}'
+    return (templates, time.time() - page_time, partial_times), None
+
+
+def build_pages_parallel(pages, pageset, options, jobs):
+    '''
+    Renders pages across jobs worker processes, each holding its own Jinja
+    environment. Returns what build_page would for each page, in the order
+    of pages, with None for pages that failed.
+    '''
+    results = []
+    failures = 0
+    with ProcessPoolExecutor(max_workers=jobs,
+                             initializer=_init_render_worker,
+                             initargs=(pageset, options)) as executor:
+        rendered = executor.map(_render_in_worker, pages,
+                                itertools.repeat(options))
+        for page, (result, error) in zip(pages, rendered):
+            if error:
+                print(f'{time.asctime()} — Failed {page["src"]}: {error}')
+                failures += 1
+            else:
+                print(f'{time.asctime()} — Built {page["src"]} to '
+                      f'{page["dest"]} in {round(float(result[1]), 4)} '
+                      'seconds')
+            results.append(result)
+    return results, failures
+
+
+def build_pageset(pageset, options, manifest=None, j2_env=None,
+                  profiler=None):
+    '''
+    Logic for building pages. If a BuildManifest is passed, every page built
+    is recorded in it, and with options['incremental'] pages whose inputs are
+    unchanged are skipped. An existing j2_env can be passed to reuse its
+    template cache. With options['jobs'] above 1, pages are rendered in that
+    many worker processes. Page timings are recorded in profiler, if given.
+    '''
 
     pages = get_pages(pageset['files'], options)
-    j2_env = get_j2_env(pageset)
+    if pageset['options'].get('nav'):
+        nav_pages = get_nav_pages(pages)
+    if j2_env is None:
+        j2_env = get_j2_env(pageset, options)
+    skipped = 0
+    to_build = []
     for page in pages:
 
         # global options
@@ -402,6 +1846,10 @@ def build_pageset(pageset, options):
         page['data']['api_url'] = options.get('api_url')
         page['data']['images_url'] = options.get('images_url')
         page['data']['stripe_publishable_key'] = options.get('stripe_publishable_key')
+        page['data']['asset_map'] = options.get('asset_map', {})
+        page['data']['image_variants'] = options.get('image_variants', {})
+        page['data']['js_common'] = options.get('js_common')
+        page['data']['empty_bundles'] = options.get('empty_bundles', [])
 
         # GLOBAL STRIPE OVERRIDE FOR DEV
         global_price_id = options.get('global_stripe_price_id')
@@ -423,7 +1871,37 @@ def build_pageset(pageset, options):
         if 'nav' in pageset['options']:
             page['data']['nav_pages'] = nav_pages
 
-        build_page(page, j2_env, options)
+        if manifest is not None:
+            data_hash = manifest.data_hash(page)
+            if (options.get('incremental')
+                    and manifest.is_fresh(page, data_hash, j2_env.loader)):
+                manifest.keep(page)
+                skipped += 1
+                continue
+        to_build.append(page)
+
+    if skipped:
+        print(f'Skipped {skipped} unchanged pages')
+
+    jobs = options.get('jobs', 1)
+    if jobs > 1 and len(to_build) > 1:
+        results, failures = build_pages_parallel(to_build, pageset, options,
+                                                 jobs)
+    else:
+        results, failures = build_pages_serial(to_build, j2_env, options)
+
+    for page, result in zip(to_build, results):
+        if result is None:
+            continue
+        templates, seconds, partial_times = result
+        if manifest is not None:
+            manifest.record(page, manifest.data_hash(page), templates,
+                            j2_env.loader)
+        if profiler is not None:
+            profiler.record_page(page, seconds, partial_times)
+    if failures:
+        raise RuntimeError(f'{failures} of {len(to_build)} pages failed '
+                           'to build')
 
 
 def build_emails(data):
@@ -449,7 +1927,8 @@ def build_emails(data):
     j2_env = Environment(
         loader=GlobLoader(template_paths),
         trim_blocks=True,
-        undefined=DebugUndefined
+        undefined=DebugUndefined,
+        bytecode_cache=get_bytecode_cache(data['options'])
     )
     j2_env.filters['markdown'] = markdown_filter
 
@@ -499,7 +1978,8 @@ def build_emails(data):
                 # Use the new layout 'email-layout-new.html' or 'email-layout.html'
                 layout_template = "{% extends 'email-layout-new.html' %}{% block content %}" + body_html + "{% endblock %}"
 
-                template = j2_env.from_string(layout_template)
+                template = template_from_string(j2_env, layout_template,
+                                                data['options'])
 
                 # Render the full HTML
                 # Pass metadata to context in case it's used
@@ -507,7 +1987,7 @@ def build_emails(data):
 
                 # OUTPUT 1: HTML File (for review)
                 html_dest_path = os.path.join(dest_dir, f"{name_no_ext}.html")
-                with open(html_dest_path, 'w') as f:
+                with atomic_write(html_dest_path) as f:
                     f.write(rendered_html)
 
                 # OUTPUT 2: JSON File (for deployment)
@@ -517,7 +1997,7 @@ def build_emails(data):
                     "Text": text_part
                 }
                 json_dest_path = os.path.join(dest_dir, f"{name_no_ext}.json")
-                with open(json_dest_path, 'w') as f:
+                with atomic_write(json_dest_path) as f:
                     json.dump(json_data, f, indent=2)
 
                 print(" Done!")
@@ -575,10 +2055,13 @@ def generate_test_pages(data, options):
         # Create a Jinja2 environment for the partial
         # We assume the partial might reference other templates, so we use the directory of the partial
         partial_dir = os.path.dirname(os.path.abspath(partial_path))
-        j2_env = Environment(loader=GlobLoader([partial_dir]), trim_blocks=True)
+        j2_env = Environment(loader=GlobLoader([partial_dir]),
+                             trim_blocks=True,
+                             bytecode_cache=get_bytecode_cache(options))
 
         try:
-            template = j2_env.from_string(open(partial_path).read())
+            with open(partial_path, 'r') as f:
+                template = template_from_string(j2_env, f.read(), options)
             rendered_partial = template.render(context)
         except Exception as e:
             print(f"    Error rendering partial {partial_path}: {e}")
@@ -601,8 +2084,12 @@ def generate_test_pages(data, options):
              link_path = f"../{css}"
              css_links += f'<link rel="stylesheet" href="{link_path}">\n'
 
-        # Build JS links
+        # Build JS links, starting with the common chunk the bundles rely on
         js_links = ""
+        js_files = [js for js in js_files
+                    if js not in options.get('empty_bundles', [])]
+        if js_files and options.get('js_common'):
+            js_files = [options['js_common']] + js_files
         for js in js_files:
              script_path = f"../{js}"
              js_links += f'<script src="{script_path}" defer></script>\n'
@@ -663,7 +2150,7 @@ def generate_test_pages(data, options):
 </html>
         """
 
-        with open(filepath, 'w') as f:
+        with atomic_write(filepath) as f:
             f.write(html_content)
 
         generated_pages.append({'name': form_name, 'file': filename})
@@ -703,7 +2190,79 @@ def generate_test_pages(data, options):
 </html>
     """
 
-    with open(index_path, 'w') as f:
+    with atomic_write(index_path) as f:
         f.write(index_content)
 
     print(f"Generated {len(generated_pages)} test pages and index.")
+
+
+# ####### #
+#  WATCH  #
+# ####### #
+
+
+class LiveBuilder:
+    '''
+    Keeps the Jinja environments and parsed page metadata warm between builds,
+    so that a changed source file only rebuilds the bundles or pages that
+    depend on it
+    '''
+
+    def __init__(self, data):
+        self.data = data
+        self.options = data['options']
+        self.j2_envs = [get_j2_env(pageset, self.options)
+                        for pageset in data.get('html', [])]
+
+    def bundles_using(self, kind, path):
+        '''Returns the js or scss bundles that include the file at path'''
+        try:
+            bundle_files = get_bundle_files(self.data, kind)
+        except FileNotFoundError:
+            return []
+        return [dest_path for dest_path, files in bundle_files.items()
+                if path in (os.path.abspath(file) for file in files)]
+
+    def rebuild(self, paths):
+        '''
+        Rebuilds whatever depends on the changed paths. Config files such as
+        data.yaml were read once at startup, so changes to them need a restart.
+        '''
+        t1 = time.time()
+        js_bundles = set()
+        scss_bundles = set()
+        html = False
+        for path in map(os.path.abspath, paths):
+            ext = os.path.splitext(path)[1]
+            if ext == '.yaml' and os.path.dirname(path) == os.getcwd():
+                print(f'{os.path.basename(path)} changed: restart watch to '
+                      'apply config changes')
+            elif ext == '.js' and 'js' in self.data:
+                js_bundles.update(self.bundles_using('js', path))
+            elif ext == '.scss' and 'scss' in self.data:
+                # Files pulled in with @import aren't listed in any bundle
+                scss_bundles.update(self.bundles_using('scss', path)
+                                    or self.data['scss']['paths'])
+            elif ext in ('.html', '.md', '.yaml'):
+                html = True
+
+        if not (js_bundles or scss_bundles or html):
+            return
+
+        for dest_path in sorted(js_bundles):
+            handle_js(self.data, dest_path)
+        if scss_bundles:
+            handle_scss_bundles(self.data, sorted(scss_bundles))
+        if self.options.get('fingerprint_assets') and (js_bundles
+                                                      or scss_bundles):
+            # Pages link to the new fingerprinted names
+            html = True
+        if html:
+            manifest = BuildManifest(self.options)
+            for pageset, j2_env in zip(self.data['html'], self.j2_envs):
+                j2_env.loader.refresh()
+                build_pageset(pageset, self.options, manifest, j2_env)
+            manifest.remove_stale()
+            manifest.save()
+            prune_bytecode_cache(self.options)
+        print(f'Rebuilt in {round(float(time.time() - t1), 4)} seconds')